@@ -1,17 +1,69 @@
-from flask import current_app, g
+from flask import current_app, g, abort
 from flask_bouncer import MANAGE, CREATE, READ, UPDATE, ALL
 
 from app.errorhandlers import unauthorized
-from app.extensions import auth, token, bouncer
+from app.extensions import db, auth, token, bouncer
 from app.awaremodel import User
-from app.users.models import RevokedToken
+from app.users.revocation import revocations, epochs
+
+
+class TokenUser(object):
+    """
+    Principal authorized from token claims alone, the user row is only loaded
+    when something beyond the cached claims is read
+    """
+    def __init__(self, id, claims):
+        self.id = id
+        self.revoked_token_count = claims['epoch']
+        self.force = claims['force']
+        self._user = None
+
+    def __repr__(self):
+        return "<{} {}>".format(self.__class__.__name__, self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, (User, TokenUser)) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((User, self.id))
+
+    def __getattr__(self, name):
+        return getattr(self.user, name)
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = User.query.get(self.id)
+        if self._user is None:
+            # deleted or deactivated while its claims were still cached
+            abort(unauthorized())
+        return self._user
+
+    def is_super(self):
+        return self.force
+
+
+def load_token_user(token):
+    data = User.load_auth_token(token)
+    if data is None:
+        return None
+
+    claims = epochs.get(data.get('id'))
+    if claims is None or claims['epoch'] != data.get('revoked_token_count'):
+        return None
+    return TokenUser(data['id'], claims)
 
 
 @auth.verify_password
 def verify_password(username, password):
     ignore_auth = current_app.config.get('IGNORE_AUTH', False)
-    g.user = User.query.get(1) if ignore_auth else User.query.filter_by(
-        username=username).first()
+    # the token issued carries the revoked_token_count read here
+    with db.primary():
+        g.user = User.query.get(1) if ignore_auth else User.query.filter_by(
+            username=username).first()
     if g.user is not None:
         return ignore_auth or g.user.verify_password(password)
     else:
@@ -21,13 +73,18 @@ def verify_password(username, password):
 @token.verify_token
 def verify_token(token):
     ignore_auth = current_app.config.get('IGNORE_AUTH', False)
-    g.user = User.query.get(1) if ignore_auth else User.verify_auth_token(token)
+    if not ignore_auth and current_app.config.get('TOKEN_VERIFICATION') == 'stateless':
+        g.user = load_token_user(token)
+        return g.user is not None
+
+    # the revoked_token_count read keys the cached revocation answers
+    with db.primary():
+        g.user = User.query.get(1) if ignore_auth else User.verify_auth_token(token)
 
     if g.user is None:
         return False
 
-    revoked = RevokedToken.get_revoked(g.user)
-    return token not in [_.token for _ in revoked]
+    return not revocations.is_revoked(g.user, token)
 
 
 @auth.error_handler
@@ -1,4 +1,5 @@
 from datetime import datetime
+from collections import namedtuple
 from inflection import tableize
 from flask import g, url_for, current_app
 from sqlalchemy.sql import expression, sqltypes
@@ -9,6 +10,8 @@ from itsdangerous import JSONWebSignatureSerializer as Serializer, BadSignature
 from itsdangerous import URLSafeTimedSerializer
 
 from app.extensions import db, bcrypt
+from app.cache import digest
+from app.metrics import BCRYPT_VERIFY
 
 
 class TablenameGenerator(object):
@@ -22,6 +25,12 @@ class utcnow(expression.FunctionElement):
     type = db.DateTime()
 
 
+@compiles(utcnow)
+def utcnow_default(element, compiler, **kwargs):
+    # SQLite and most other databases keep CURRENT_TIMESTAMP in UTC
+    return "CURRENT_TIMESTAMP"
+
+
 @compiles(utcnow, 'postgresql')
 def pg_utcnow(element, compiler, **kwargs):
     return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
@@ -29,8 +38,14 @@ def pg_utcnow(element, compiler, **kwargs):
 
 class Timestamp(object):
     """Give models awareness of time the are created and altered on"""
-    created_at = db.Column(db.DateTime, server_default=utcnow())
-    modified_at = db.Column(db.DateTime, server_default=utcnow(), onupdate=utcnow())
+    created_at = db.Column(db.DateTime, nullable=False, server_default=utcnow())
+    modified_at = db.Column(db.DateTime, nullable=False, server_default=utcnow(),
+                            onupdate=utcnow())
+
+
+DATE_TYPES = (sqltypes.DateTime, sqltypes.Date, sqltypes.Time, sqltypes.TIMESTAMP)
+INT_TYPES = (sqltypes.BigInteger, sqltypes.SmallInteger, sqltypes.Integer)
+DEC_TYPES = (sqltypes.REAL, sqltypes.DECIMAL, sqltypes.Numeric, sqltypes.Float)
 
 
 def get_columns(model):
@@ -41,6 +56,10 @@ def get_relationships(model):
     return model.__mapper__.relationships
 
 
+def weak_etag(*parts):
+    return digest(':'.join(str(_) for _ in parts))
+
+
 def get_url(obj, **kwargs):
     req = kwargs.pop('request', None)
     extra = kwargs.pop('extra', None)
@@ -54,88 +73,180 @@ def get_url(obj, **kwargs):
     return url_for(endpoint, **kwargs)
 
 
-def import_data(obj, method, data):
-    columns = get_columns(obj)
-    date_type = (sqltypes.DateTime, sqltypes.Date, sqltypes.Time, sqltypes.TIMESTAMP)
-    int_type = (sqltypes.Integer, sqltypes.BigInteger, sqltypes.SmallInteger)
-    dec_type = (sqltypes.REAL, sqltypes.DECIMAL, sqltypes.Numeric, sqltypes.Float)
-
-    if method == 'POST':
-        required = [_ for _ in columns.keys() if not columns.get(_).nullable]
-        for key in set(required).difference(data.keys()):
-            setattr(obj, key, None)
-
-    for key in set(data.keys()).intersection(columns.keys()):
-        if key == 'password' and hasattr(obj, 'set_password'):
-            obj.set_password(data[key])
-        elif isinstance(columns.get(key).type, date_type):
-            setattr(obj, key, datetime.strptime(data[key], '%Y-%m-%d'))
-        elif isinstance(columns.get(key).type, sqltypes.Boolean):
-            setattr(obj, key, bool(data[key]))
-        elif isinstance(columns.get(key).type, int_type):
-            setattr(obj, key, int(data[key]))
-        elif isinstance(columns.get(key).type, dec_type):
-            setattr(obj, key, float(data[key]))
+_auth_serializers = {}
+
+
+def auth_serializer():
+    """
+    Serializer of the auth tokens. Stateless verification trusts their claims
+    without loading the user, so it requires them signed with SECRET_KEY.
+    """
+    secret = current_app.config['SECRET_KEY']
+    signed = current_app.config.get('TOKEN_VERIFICATION') == 'stateless'
+    s = _auth_serializers.get((secret, signed))
+    if s is None:
+        if signed:
+            s = Serializer(secret, algorithm_name='HS256')
         else:
-            setattr(obj, key, str(data[key]) if len(data[key]) > 0 else None)
+            s = Serializer(secret, algorithm_name='none', signer_kwargs={'sep': '&'})
+        _auth_serializers[(secret, signed)] = s
+    return s
+
+
+def _import_date(value):
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
+def _import_str(value):
+    return str(value) if len(value) > 0 else None
+
+
+def import_converter(column):
+    """Pick once the coercion a request value goes through before assignment"""
+    if isinstance(column.type, DATE_TYPES):
+        return _import_date
+    if isinstance(column.type, sqltypes.Boolean):
+        return bool
+    if isinstance(column.type, INT_TYPES):
+        return int
+    if isinstance(column.type, DEC_TYPES):
+        return float
+    return _import_str
+
+
+ImportPlan = namedtuple('ImportPlan', ['converters', 'required', 'hashes_password'])
+_import_plans = {}
+
+
+def import_plan(model):
+    """
+    Compile once per mapper the column converters, the non nullable columns
+    without a default a POST resets and whether passwords go through the model's
+    set_password hook
+    """
+    mapper = model.__mapper__
+    plan = _import_plans.get(mapper)
+    if plan is None:
+        columns = get_columns(model)
+        plan = _import_plans[mapper] = ImportPlan(
+            {key: import_converter(column) for key, column in columns.items()},
+            tuple(key for key, column in columns.items()
+                  if not column.nullable and column.server_default is None),
+            'password' in columns and hasattr(model, 'set_password'))
+    return plan
+
+
+def coerce_data(model, method, data):
+    """
+    Coerce request data into column values in one pass, a password handled by
+    the set_password hook is passed through as given
+    """
+    plan = import_plan(model)
+    values = dict.fromkeys(plan.required) if method == 'POST' else {}
+    for key, value in data.items():
+        convert = plan.converters.get(key)
+        if convert is None:
+            continue
+        if key == 'password' and plan.hashes_password:
+            values[key] = value
+        else:
+            values[key] = convert(value)
+    return values
+
+
+def import_data(obj, method, data):
+    values = coerce_data(obj, method, data)
+    if import_plan(obj).hashes_password and 'password' in data:
+        obj.set_password(values.pop('password'))
+
+    for key, value in values.items():
+        setattr(obj, key, value)
     return obj
 
 
-def export_data(obj, **kwargs):
-    data = dict()
-    columns = get_columns(obj)
-    relationships = get_relationships(obj)
-    date_type = (sqltypes.DateTime, sqltypes.Date, sqltypes.Time, sqltypes.TIMESTAMP)
-    int_type = (sqltypes.BigInteger, sqltypes.SmallInteger, sqltypes.Integer)
-    dec_type = (sqltypes.REAL, sqltypes.DECIMAL, sqltypes.Numeric, sqltypes.Float)
+def _export_date(value):
+    return value.isoformat()
 
-    data['self_url'] = obj.get_url(**kwargs)
 
-    for key in columns.keys():
-        if key in obj.IGNORE_FIELDS:
-            continue
+def _export_bool(value):
+    return str(value).lower()
 
-        # assign null for data without any value
-        col_value = getattr(obj, key)
-        if col_value is None:
-            data[key] = None
-            continue
 
-        # check if the column type is datetime and convert to datetime for serialization
-        if isinstance(columns.get(key).type, date_type):
-            data[key] = col_value.isoformat()
-            continue
+def export_converter(column):
+    """Pick once the conversion a column value goes through on serialization"""
+    if isinstance(column.type, DATE_TYPES):
+        return _export_date
+    if isinstance(column.type, sqltypes.Boolean):
+        return _export_bool
+    if isinstance(column.type, INT_TYPES):
+        return int
+    if isinstance(column.type, DEC_TYPES):
+        return float
+    return str
 
-        if isinstance(columns.get(key).type, sqltypes.Boolean):
-            data[key] = str(col_value).lower()
-            continue
 
-        if isinstance(columns.get(key).type, int_type):
-            data[key] = int(col_value)
-            continue
+_export_plans = {}
 
-        if isinstance(columns.get(key).type, dec_type):
-            data[key] = float(col_value)
-            continue
 
-        data[key] = str(col_value)
+def export_plan(model):
+    """
+    Compile once per mapper the ordered (attribute, converter) steps and the
+    relationship names export_data goes through for every row
+    """
+    mapper = model.__mapper__
+    plan = _export_plans.get(mapper)
+    if plan is None:
+        columns = tuple(
+            (key, export_converter(column)) for key, column in get_columns(model).items()
+            if key not in model.IGNORE_FIELDS)
+        plan = _export_plans[mapper] = (columns, tuple(get_relationships(model).keys()))
+    return plan
 
-    for key in relationships.keys():
+
+def export_row(model, row, data=None):
+    """Serialize the exported columns of any row with the model's attributes"""
+    data = {} if data is None else data
+    for key, convert in export_plan(model)[0]:
+        # assign null for data without any value
+        value = getattr(row, key)
+        data[key] = None if value is None else convert(value)
+    return data
+
+
+def export_data(obj, **kwargs):
+    relationships = export_plan(obj)[1]
+    data = export_row(obj, obj, {'self_url': obj.get_url(**kwargs)})
+
+    if relationships:
         req = kwargs.get('request', None)
-        if req:
-            endpoint = '{}.list_{}'.format(req.endpoint.split('.')[0], key)
-        else:
-            endpoint = '{}.list_{}'.format(obj.__tablename__, key)
-        try:
-            data['{}_url'.format(key)] = url_for(endpoint, id=obj.id, _external=True)
-        except Exception:
-            pass
+        prefix = req.endpoint.split('.')[0] if req else obj.__tablename__
+        views = current_app.view_functions
+        for key in relationships:
+            endpoint = '{}.list_{}'.format(prefix, key)
+            if endpoint in views:
+                data['{}_url'.format(key)] = url_for(endpoint, id=obj.id, _external=True)
 
     return data
 
 
+def remove(obj, soft=None):
+    if soft is None:
+        soft = current_app.config.get('SOFT_DELETE', False)
+
+    if soft:
+        obj.active = False
+        db.session.add(obj)
+    else:
+        db.session.delete(obj)
+    db.session.commit()
+
+
 class User(db.Model, TablenameGenerator, Timestamp):
     IGNORE_FIELDS = ['id', 'password']
+    __table_args__ = (
+        db.Index('ix_users_created_at_id_active', 'created_at', 'id',
+                 postgresql_where=db.text('active')),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(127), unique=True, nullable=True)
@@ -158,9 +269,8 @@ class User(db.Model, TablenameGenerator, Timestamp):
         db.session.add(self)
         db.session.commit()
 
-    def remove(self):
-        db.session.delete(self)
-        db.session.commit()
+    def remove(self, soft=None):
+        remove(self, soft=soft)
 
     def is_super(self):
         return self.force
@@ -174,6 +284,9 @@ class User(db.Model, TablenameGenerator, Timestamp):
     def export_data(self, **kwargs):
         return export_data(self, **kwargs)
 
+    def get_etag(self):
+        return weak_etag(self.__tablename__, self.id, self.modified_at)
+
     def import_data(self, method, data):
         return import_data(self, method, data)
 
@@ -181,22 +294,25 @@ class User(db.Model, TablenameGenerator, Timestamp):
         self.password = bcrypt.generate_password_hash(password).decode('utf-8')
 
     def verify_password(self, password):
-        return bcrypt.check_password_hash(self.password, password)
+        with BCRYPT_VERIFY.time():
+            return bcrypt.check_password_hash(self.password, password)
 
     def generate_auth_token(self):
-        s = Serializer(
-            current_app.config['SECRET_KEY'], algorithm_name='none', signer_kwargs={'sep': '&'})
         payload = {'id': self.id, 'revoked_token_count': self.revoked_token_count}
-        return s.dumps(payload).decode('utf-8')
+        return auth_serializer().dumps(payload).decode('utf-8')
 
     @staticmethod
-    def verify_auth_token(token):
-        s = Serializer(
-            current_app.config['SECRET_KEY'], algorithm_name='none', signer_kwargs={'sep': '&'})
+    def load_auth_token(token):
         try:
-            data = s.loads(token)
+            return auth_serializer().loads(token)
         except BadSignature:
             return None
+
+    @staticmethod
+    def verify_auth_token(token):
+        data = User.load_auth_token(token)
+        if data is None:
+            return None
         return User.query.get(data['id'])
 
     def generate_confirmation_token(self):
@@ -271,9 +387,8 @@ class AwareModel(db.Model, TablenameGenerator, Timestamp, Agent):
         db.session.add(self)
         db.session.commit()
 
-    def remove(self):
-        db.session.delete(self)
-        db.session.commit()
+    def remove(self, soft=None):
+        remove(self, soft=soft)
 
     def get_url(self, **kwargs):
         return get_url(self, **kwargs)
@@ -281,6 +396,9 @@ class AwareModel(db.Model, TablenameGenerator, Timestamp, Agent):
     def export_data(self, **kwargs):
         return export_data(self, **kwargs)
 
+    def get_etag(self):
+        return weak_etag(self.__tablename__, self.id, self.modified_at)
+
     def import_data(self, method, data):
         return import_data(self, method, data)
 
@@ -0,0 +1,126 @@
+import time
+import hashlib
+from collections import OrderedDict
+from redis.exceptions import RedisError
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session
+
+from app.extensions import redis_store
+
+
+class LocalCache(object):
+    """Process local cache with expiring entries and a bounded size"""
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+
+        value, expires = entry
+        if expires < time.monotonic():
+            self.entries.pop(key, None)
+            return default
+        return value
+
+    def set(self, key, value, ttl):
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def digest(value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return hashlib.sha1(value).hexdigest()
+
+
+# redis is a cache only, an unreachable server must never fail a request
+def cache_get(key):
+    if redis_store.client is None:
+        return None
+    try:
+        return redis_store.get(key)
+    except RedisError:
+        return None
+
+
+def cache_set(key, value, ttl):
+    if redis_store.client is None:
+        return
+    try:
+        redis_store.set(key, value, ex=ttl)
+    except RedisError:
+        pass
+
+
+def cache_incr(key):
+    if redis_store.client is None:
+        return
+    try:
+        redis_store.incr(key)
+    except RedisError:
+        pass
+
+
+def cache_delete(*keys):
+    if redis_store.client is None or not keys:
+        return
+    try:
+        redis_store.delete(*keys)
+    except RedisError:
+        pass
+
+
+# generations let a whole family of cached entries go stale with one increment,
+# the local part keeps a process consistent with its own writes without redis
+_generations = {}
+
+
+def generation(name):
+    cached = cache_get('generation:{}'.format(name))
+    return '{}.{}'.format(int(cached or 0), _generations.get(name, 0))
+
+
+def bump_generation(name):
+    _generations[name] = _generations.get(name, 0) + 1
+    cache_incr('generation:{}'.format(name))
+
+
+def bump_on_commit(session, name):
+    """
+    Bump a generation once the session commits. Bumped at flush time, a reader
+    could fill the new generation with rows from before the commit, and a
+    rollback would have bumped for nothing.
+    """
+    session.info.setdefault('generations', set()).add(name)
+
+
+@listens_for(Session, 'after_commit')
+def bump_committed(session):
+    for name in session.info.pop('generations', ()):
+        bump_generation(name)
+
+
+@listens_for(Session, 'after_rollback')
+def drop_rolled_back(session):
+    session.info.pop('generations', None)
+
+
+# families of cached entries derived from a table's rows, for writes that
+# bypass the ORM events keeping them fresh, called once they are committed
+TABLE_GENERATIONS = ('count', 'response')
+
+
+def table_changed(table):
+    for family in TABLE_GENERATIONS:
+        bump_generation('{}:{}'.format(family, table))
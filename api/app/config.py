@@ -1,14 +1,19 @@
 import os
-from flask.cli import load_dotenv
-from celery.schedules import crontab
+from dotenv import load_dotenv
+
+
+PROJECT_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+# read once before the classes below, variables already in the environment win
+for filename in ('.flaskenv', '.env'):
+    if os.path.exists(os.path.join(PROJECT_DIR, filename)):
+        load_dotenv(os.path.join(PROJECT_DIR, filename))
 
 
 class Base:
     """
     Base configuration
     """
-    PROJECT_DIR = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
-    load_dotenv(os.path.join(PROJECT_DIR, '.flaskenv'))
+    PROJECT_DIR = PROJECT_DIR
 
     DEBUG = False
     TESTING = False
@@ -22,8 +27,77 @@ class Base:
     DB_PORT = os.environ.get('POSTGRES_PORT')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Connection pool per process: size and overflow bound the connections each
+    # worker opens, recycle and pre-ping keep stale ones out, statement timeout is
+    # in milliseconds (0 disables). DB_PGBOUNCER drops the pool for PgBouncer in
+    # transaction mode.
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+    DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+    DB_PGBOUNCER = os.environ.get('DB_PGBOUNCER', 'false').lower() == 'true'
+
+    # Read replicas, comma separated URIs. Reads of GET requests go to a replica
+    # lagging at most DB_REPLICA_MAX_LAG seconds, probed every DB_REPLICA_CHECK_INTERVAL
+    DB_REPLICA_URIS = [_ for _ in os.environ.get('DB_REPLICA_URIS', '').split(',') if _]
+    DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))
+    DB_REPLICA_CHECK_INTERVAL = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 5))
+
+    # Exist validators run one query each ("query"), one batched query ("batch")
+    # or leave uniqueness to the database constraints ("constraint")
+    UNIQUE_VALIDATION = os.environ.get('UNIQUE_VALIDATION', 'batch')
+
+    # Bulk endpoints: most items per request and threads hashing passwords
+    BULK_MAX_ITEMS = 1000
+    BULK_HASH_WORKERS = os.cpu_count() or 1
+
+    # remove() deactivates rows instead of deleting them
+    SOFT_DELETE = os.environ.get('SOFT_DELETE', 'false').lower() == 'true'
+
+    # flask, orjson, rapidjson, ujson or auto for the fastest installed
+    JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')
+
     # Redis configuration
     REDIS_URI = 'redis://redis:6379/0'
+    REDIS_SOCKET_TIMEOUT = 0.5
+
+    # Cache encoded GET responses of @cached endpoints in redis
+    RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'true').lower() == 'true'
+
+    # Seconds a revoked token lookup stays cached
+    REVOKED_TOKEN_CACHE_TTL = 300
+
+    # Token verification either loads the user row per request ("database") or
+    # trusts the signed claims checked against a cached revocation epoch ("stateless")
+    TOKEN_VERIFICATION = os.environ.get('TOKEN_VERIFICATION', 'database')
+    TOKEN_EPOCH_CACHE_TTL = 300
+    TOKEN_EPOCH_LOCAL_TTL = 5
+
+    # Paginated totals, cached counts expire after COUNT_CACHE_TTL seconds and
+    # planner estimates below COUNT_ESTIMATE_MIN rows are recounted exactly
+    COUNT_CACHE_TTL = 60
+    COUNT_ESTIMATE_MIN = 1000
+
+    # Count SQL per request, send it in a Server-Timing header and log requests
+    # running more statements than their endpoint's budget (QUERY_BUDGETS maps
+    # endpoints to budgets, QUERY_BUDGET is the default, None disables)
+    SERVER_TIMING = os.environ.get('SERVER_TIMING', 'false').lower() == 'true'
+    QUERY_BUDGET = 20
+    QUERY_BUDGETS = {}
+    QUERY_BUDGET_STRICT = False
+    # a SELECT repeated this many times in one request is flagged as N+1, None disables
+    N_PLUS_ONE_THRESHOLD = 5
+
+    # Prometheus exposition on /metrics and the broker queues it reports the depth of
+    METRICS = os.environ.get('METRICS', 'true').lower() == 'true'
+    METRICS_CELERY_QUEUES = ['celery']
+
+    # Register the blueprints, CORS and authorization when the URL map is first
+    # needed instead of in create_app, commands and workers that never route skip
+    # them (flask routes then lists the blueprints only with LAZY_INIT=false)
+    LAZY_INIT = os.environ.get('LAZY_INIT', 'true').lower() == 'true'
 
     # Celery configuration
     CELERY_TASK_STARTED = True
@@ -43,6 +117,7 @@ class Base:
 class Development(Base):
     """Development configuration"""
     DEBUG = True
+    SERVER_TIMING = True
     DB_URI = 'postgresql://{}:{}@{}:{}/{}'.format(
         Base.DB_USER, Base.DB_PASS, Base.DB_HOST, Base.DB_PORT, Base.DB)
     SQLALCHEMY_DATABASE_URI = DB_URI
@@ -51,6 +126,10 @@ class Development(Base):
 class Testing(Development):
     """Testing configuration"""
     TESTING = True
+    # rolled back test data must never be served from a previous test's cache
+    RESPONSE_CACHE = False
+    # a test whose request runs over its query budget or lazy loads per row fails
+    QUERY_BUDGET_STRICT = os.environ.get('QUERY_BUDGET_STRICT', 'false').lower() == 'true'
     DB_URI = 'postgresql://{}:{}@{}:{}/{}_test'.format(
         Base.DB_USER, Base.DB_PASS, Base.DB_TEST_HOST, Base.DB_PORT, Base.DB
     )
@@ -60,7 +139,7 @@ class Testing(Development):
 class Production(Development):
     """Production configuration"""
     DEBUG = False
-    load_dotenv(os.path.join(Base.PROJECT_DIR, '.env'))
+    SERVER_TIMING = Base.SERVER_TIMING
     DB_URI = 'postgresql://{}:{}@db:{}/{}'.format(
         Base.DB_USER, Base.DB_PASS, Base.DB_PORT, Base.DB
     )
@@ -1,13 +1,14 @@
 import pytest
 from datetime import datetime
 from flask import g, current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 
 from app.worker import celery
 from app.awaremodel import User
 from app.factory import create_app
 from app.extensions import db as _db
-from app.users.routes import registration_setup
 
 
 @pytest.fixture(scope='session')
@@ -45,8 +46,26 @@ def db_session(db, monkeypatch):
     trans = conn.begin()
     # Patch Flask-SQLAlchemy to use our connection
     monkeypatch.setattr(db, 'get_engine', lambda *args: conn)
+    # sessions run in a savepoint released on commit, a rollback of the
+    # application (e.g. on an IntegrityError) goes back to the last commit
+    # instead of dropping the rows the fixtures created
+    savepoint = [conn.begin_nested()]
+
+    def release_savepoint(session):
+        savepoint[0].commit()
+        savepoint[0] = conn.begin_nested()
+
+    def restart_savepoint(session, transaction):
+        if not savepoint[0].is_active:
+            savepoint[0] = conn.begin_nested()
+
+    event.listen(Session, 'after_commit', release_savepoint)
+    event.listen(Session, 'after_transaction_end', restart_savepoint)
     yield db.session
+    event.remove(Session, 'after_commit', release_savepoint)
+    event.remove(Session, 'after_transaction_end', restart_savepoint)
     db.session.remove()
+    savepoint[0].rollback()
     trans.rollback()
     conn.close()
 
@@ -83,7 +102,6 @@ def user(db_session):
     user.set_password('user')
     g.user = user
     user.save()
-    registration_setup(user)
     yield User.query.filter_by(username='user').first()
     user.remove()
 
@@ -0,0 +1,106 @@
+import json
+from flask import current_app
+from sqlalchemy import inspect
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import object_session
+
+from app.extensions import db
+from app.awaremodel import AwareModel, User
+from app.cache import LocalCache, digest, cache_get, cache_set, generation, bump_on_commit
+
+
+EXACT = 'exact'
+CACHED = 'cached'
+ESTIMATE = 'estimate'
+
+_counts = LocalCache()
+
+
+def query_table(query):
+    return query.column_descriptions[0]['entity'].__table__.name
+
+
+def compile_query(query):
+    statement = query.order_by(None).statement
+    return statement.compile(dialect=query.session.get_bind().dialect)
+
+
+def exact_count(query):
+    return query.order_by(None).count(), False
+
+
+def cached_count(query):
+    """Exact count remembered until the TTL expires or a row is inserted or deleted"""
+    compiled = compile_query(query)
+    table = query_table(query)
+    key = 'count:{}:{}:{}'.format(table, generation('count:{}'.format(table)), digest(
+        '{}{}'.format(compiled, sorted(compiled.params.items(), key=lambda _: _[0]))))
+
+    total = _counts.get(key)
+    if total is None:
+        cached = cache_get(key)
+        ttl = current_app.config.get('COUNT_CACHE_TTL', 60)
+        if cached is None:
+            with db.primary():
+                total, _ = exact_count(query)
+            cache_set(key, total, ttl)
+        else:
+            total = int(cached)
+        _counts.set(key, total, ttl)
+    return total, False
+
+
+def estimated_count(query):
+    """
+    PostgreSQL planner estimate, pg_class.reltuples for unfiltered queries and the
+    EXPLAIN row estimate otherwise; small or unanalyzed tables are counted exactly
+    """
+    connection = query.session.connection()
+    if connection.dialect.name != 'postgresql':
+        return exact_count(query)
+
+    # filters like the active one are only added when the query compiles,
+    # the compiled statement tells whether the whole table is counted
+    compiled = compile_query(query)
+    if compiled.statement._whereclause is None:
+        total = connection.execute(
+            'SELECT reltuples FROM pg_class WHERE oid = %(table)s::regclass',
+            {'table': query_table(query)}).scalar()
+    else:
+        plan = connection.execute(
+            'EXPLAIN (FORMAT JSON) {}'.format(compiled), compiled.params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        total = plan[0]['Plan']['Plan Rows']
+
+    if total is None or total < current_app.config.get('COUNT_ESTIMATE_MIN', 1000):
+        return exact_count(query)
+    return int(total), True
+
+
+strategies = {
+    EXACT: exact_count,
+    CACHED: cached_count,
+    ESTIMATE: estimated_count
+}
+
+
+def count_rows(query, mode=EXACT):
+    """Returns the total rows of a query and whether it is an estimate"""
+    return strategies[mode](query)
+
+
+@listens_for(AwareModel, 'after_insert', propagate=True)
+@listens_for(AwareModel, 'after_delete', propagate=True)
+@listens_for(User, 'after_insert')
+@listens_for(User, 'after_delete')
+def rows_changed(mapper, connection, target):
+    bump_on_commit(object_session(target), 'count:{}'.format(mapper.local_table.name))
+
+
+@listens_for(AwareModel, 'after_update', propagate=True)
+@listens_for(User, 'after_update')
+def activity_changed(mapper, connection, target):
+    # soft deletes and reactivations change what active queries count
+    if inspect(target).attrs.active.history.has_changes():
+        bump_on_commit(object_session(target), 'count:{}'.format(mapper.local_table.name))
@@ -1,2 +1,5 @@
 from app.decorators.validate_with import validate_with    # NOQA
 from app.decorators.paginate import paginate    # NOQA
+from app.decorators.cached import cached    # NOQA
+from app.decorators.query_budget import query_budget    # NOQA
+from app.decorators.use_primary import use_primary    # NOQA
@@ -0,0 +1,119 @@
+import json
+import time
+import functools
+from collections import Counter
+from flask import request, current_app, g, Response
+from redis.exceptions import RedisError
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import object_session
+
+from app.extensions import db, redis_store
+from app.awaremodel import AwareModel, User
+from app.cache import digest, generation, bump_on_commit, cache_incr
+from app.factory import APIResult
+
+
+# hits, misses and waits per endpoint in this process, redis keeps the totals
+stats = Counter()
+
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Link')
+
+
+def cache_key(models):
+    generations = '.'.join(
+        generation('response:{}'.format(_.__tablename__)) for _ in models)
+    user = getattr(g, 'user', None)
+    parts = json.dumps([request.view_args, getattr(user, 'id', None),
+                        request.query_string.decode('utf-8')], sort_keys=True, default=str)
+    return 'response:{}:{}:{}'.format(request.endpoint, generations, digest(parts))
+
+
+def dump_response(rv):
+    headers = {key: rv.headers[key] for key in KEPT_HEADERS if key in rv.headers}
+    meta = json.dumps({'status': rv.status_code, 'headers': headers}).encode('utf-8')
+    return meta + b'\n' + rv.get_data()
+
+
+def load_response(blob):
+    meta, body = blob.split(b'\n', 1)
+    meta = json.loads(meta.decode('utf-8'))
+    rv = Response(body, status=meta['status'], headers=meta['headers'])
+
+    # the stored response may still satisfy the request's conditional headers
+    etag = rv.get_etag()[0]
+    result = APIResult(None, etag=etag, last_modified=rv.last_modified, **{
+        key: value for key, value in meta['headers'].items()
+        if key not in ('ETag', 'Last-Modified', 'Content-Type')})
+    return result.not_modified() if result.is_fresh() else rv
+
+
+def count(event):
+    stats['{}:{}'.format(request.endpoint, event)] += 1
+    cache_incr('response:{}:{}'.format(event, request.endpoint))
+
+
+def cached(models, ttl=60, lock_ttl=10, wait=0.05, retries=20):
+    """
+    Caches encoded GET responses in redis per endpoint, view arguments, principal
+    and query string. Entries are dropped when rows of the given models change.
+    While one request builds a missing entry others wait for it instead of
+    stampeding the database.
+    """
+    models = tuple(models) if isinstance(models, (list, tuple)) else (models,)
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            if request.method != 'GET' or redis_store.client is None or \
+                    not current_app.config.get('RESPONSE_CACHE', True):
+                return f(*args, **kwargs)
+
+            key = cache_key(models)
+            locked = False
+            try:
+                blob = redis_store.get(key)
+                if blob is None:
+                    locked = redis_store.set(key + ':lock', 1, nx=True, ex=lock_ttl)
+                    for _ in range(0 if locked else retries):
+                        time.sleep(wait)
+                        blob = redis_store.get(key)
+                        if blob is not None:
+                            count('wait')
+                            break
+            except RedisError:
+                return f(*args, **kwargs)
+
+            if blob is not None:
+                count('hit')
+                return load_response(blob)
+
+            count('miss')
+            try:
+                # the entry outlives any replica lag, build it from the primary
+                with db.primary():
+                    rv = current_app.make_response(f(*args, **kwargs))
+                if rv.status_code == 200 and not rv.is_streamed:
+                    try:
+                        redis_store.set(key, dump_response(rv), ex=ttl)
+                    except RedisError:
+                        pass
+            finally:
+                # whatever the outcome, waiting requests must not sit out lock_ttl
+                if locked:
+                    try:
+                        redis_store.delete(key + ':lock')
+                    except RedisError:
+                        pass
+            return rv
+        return wrapped
+    return decorator
+
+
+@listens_for(AwareModel, 'after_insert', propagate=True)
+@listens_for(AwareModel, 'after_update', propagate=True)
+@listens_for(AwareModel, 'after_delete', propagate=True)
+@listens_for(User, 'after_insert')
+@listens_for(User, 'after_update')
+@listens_for(User, 'after_delete')
+def rows_changed(mapper, connection, target):
+    bump_on_commit(object_session(target), 'response:{}'.format(mapper.local_table.name))
@@ -1,11 +1,211 @@
+import json
+import base64
+import binascii
 import functools
-from flask import url_for, request
+from datetime import date, datetime
+from decimal import Decimal
+from flask import url_for, request, abort
+from flask_sqlalchemy import Pagination
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.sql import sqltypes
 
-from app.factory import APIResult
+from app.factory import APIResult, APIException
+from app.counting import EXACT, count_rows
+from app.awaremodel import weak_etag
 
 
-def paginate(collection, version=None, max_per_page=25):
-    """Converts a database query into a collection containing pages and its details"""
+def encode_cursor(column, item, direction):
+    value = getattr(item, column.key)
+    if isinstance(value, (date, datetime)):
+        value = value.isoformat()
+    elif isinstance(value, Decimal):
+        value = str(value)
+    position = json.dumps({'v': value, 'id': item.id, 'd': direction}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(column, cursor):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8'))
+        value, id, direction = position['v'], position['id'], position['d']
+        # a tampered value must fail here, not as a type error inside the query
+        if isinstance(column.type, sqltypes.DateTime):
+            value = datetime.fromisoformat(value)
+        elif isinstance(column.type, sqltypes.Date):
+            value = date.fromisoformat(value)
+        elif isinstance(column.type, sqltypes.Numeric):
+            value = Decimal(value) if isinstance(value, str) else None
+            if value is not None and not value.is_finite():
+                value = None
+        elif isinstance(column.type, sqltypes.Integer):
+            value = value if _is_int(value) else None
+        elif isinstance(column.type, sqltypes.String):
+            value = value if isinstance(value, str) else None
+    except (binascii.Error, ValueError, TypeError, KeyError, ArithmeticError):
+        raise APIException('invalid cursor', 400)
+    if value is None or not _is_int(id) or direction not in ('next', 'prev'):
+        raise APIException('invalid cursor', 400)
+    return value, id, direction
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+# types whose values survive the JSON round trip of a cursor, floats excluded
+CURSOR_TYPES = (sqltypes.DateTime, sqltypes.Date, sqltypes.Integer, sqltypes.String,
+                sqltypes.Numeric)
+
+
+def cursor_column(entity, order, allowed):
+    """
+    The column keyset pages are ordered on, one the endpoint allows that is
+    exported and never NULL (a NULL drops out of the (column, id) comparison)
+    """
+    column = entity.__table__.columns.get(order) if order in allowed else None
+    if column is None or column.nullable or order in entity.IGNORE_FIELDS:
+        raise APIException('invalid order_by {}'.format(order), 400)
+    if isinstance(column.type, sqltypes.Float) or not isinstance(column.type, CURSOR_TYPES):
+        raise APIException('invalid order_by {}'.format(order), 400)
+    return getattr(entity, order)
+
+
+def eager_options(query, eager):
+    """
+    Loader options for the relationship names a paginated endpoint declares:
+    scalar relationships are joined into the page query, collections are
+    fetched with one extra SELECT ... IN for the whole page
+    """
+    entity = query.column_descriptions[0]['entity']
+    relationships = entity.__mapper__.relationships
+    options = []
+    for name in eager or ():
+        if not isinstance(name, str):
+            options.append(name)
+            continue
+        attribute = getattr(entity, name)
+        options.append(
+            selectinload(attribute) if relationships[name].uselist else joinedload(attribute))
+    return options
+
+
+def paginate_pages(query, order, per_page, expanded, count=EXACT, eager=None, **kwargs):
+    """Page number pagination with OFFSET, the total comes from the count strategy"""
+    page = request.args.get('page', 1, type=int)
+    # as Flask-SQLAlchemy's paginate did, no LIMIT below one reaches the database
+    if page < 1 or per_page < 1:
+        abort(404)
+
+    total, estimated = count_rows(query, count)
+    query = query.options(*eager_options(query, eager))
+    items = query.order_by(order).limit(per_page).offset((page - 1) * per_page).all()
+    if not items and page != 1:
+        abort(404)
+    p = Pagination(query, page, per_page, total, items)
+
+    # build the pagination metadata to include in the response
+    pages = {'page': page, 'per_page': per_page, 'total': p.total, 'pages': p.pages,
+             'estimated': estimated}
+
+    if p.has_prev:
+        pages['prev_url'] = url_for(
+            request.endpoint, page=p.prev_num, per_page=per_page,
+            expanded=expanded, _external=True, **kwargs)
+    else:
+        pages['prev_url'] = None
+
+    if p.has_next:
+        pages['next_url'] = url_for(
+            request.endpoint, page=p.next_num, per_page=per_page,
+            expanded=expanded, _external=True, **kwargs)
+    else:
+        pages['next_url'] = None
+
+    pages['first_url'] = url_for(request.endpoint, page=1, per_page=per_page,
+                                 expanded=expanded, _external=True, **kwargs)
+    pages['last_url'] = url_for(request.endpoint, page=p.pages, per_page=per_page,
+                                expanded=expanded, _external=True, **kwargs)
+    return items, pages
+
+
+def paginate_cursor(query, order, per_page, expanded, count=EXACT, eager=None, columns=(),
+                    **kwargs):
+    """
+    Keyset pagination seeking on (order column, id), no OFFSET scan and the total
+    only counted when asked for with total=1. order must be one of columns.
+    """
+    if per_page < 1:
+        abort(404)
+    entity = query.column_descriptions[0]['entity']
+    column = cursor_column(entity, order, columns)
+
+    key = tuple_(column, entity.id)
+    cursor = request.args.get('cursor', '', type=str)
+    total, estimated = count_rows(query, count) if request.args.get(
+        'total', 0, type=int) else (None, False)
+
+    if cursor:
+        value, id, direction = decode_cursor(column, cursor)
+    else:
+        value, id, direction = None, None, 'next'
+
+    if direction == 'next':
+        if cursor:
+            query = query.filter(key > (value, id))
+        query = query.order_by(column, entity.id)
+    else:
+        query = query.filter(key < (value, id)).order_by(column.desc(), entity.id.desc())
+
+    items = query.options(*eager_options(query, eager)).limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+
+    if direction == 'next':
+        has_prev, has_next = bool(cursor), has_more
+    else:
+        items.reverse()
+        has_prev, has_next = has_more, True
+
+    pages = {'per_page': per_page, 'total': total, 'estimated': estimated,
+             'prev_url': None, 'next_url': None}
+    if items and has_prev:
+        pages['prev_url'] = url_for(
+            request.endpoint, cursor=encode_cursor(column, items[0], 'prev'), order_by=order,
+            per_page=per_page, expanded=expanded, _external=True, **kwargs)
+    if items and has_next:
+        pages['next_url'] = url_for(
+            request.endpoint, cursor=encode_cursor(column, items[-1], 'next'), order_by=order,
+            per_page=per_page, expanded=expanded, _external=True, **kwargs)
+    pages['first_url'] = url_for(request.endpoint, cursor='', order_by=order, per_page=per_page,
+                                 expanded=expanded, _external=True, **kwargs)
+    return items, pages
+
+
+def page_etag(items, pages):
+    """
+    Weak etag of a page from its rows' ids and modification times and its
+    pagination metadata. A row of the page inserted, changed or deleted, or
+    one shifting it, changes it without aggregating over the whole table.
+    """
+    rows = [(_.id, getattr(_, 'modified_at', None)) for _ in items]
+    return weak_etag(request.full_path, rows, sorted(pages.items()))
+
+
+def paginate(collection, version=None, max_per_page=25, cursor=(), count=EXACT,
+             conditional=False, eager=None):
+    """
+    Converts a database query into a collection containing pages and its details.
+
+    Endpoints naming the columns keyset pages may be ordered on in cursor switch
+    to keyset pagination when the request carries a cursor argument, an empty
+    cursor asks for the first page.
+    count picks how totals are obtained: exact, cached or estimate.
+    conditional=True answers 304 when the page has not changed, before its rows
+    are serialized.
+    eager names the relationships (or loader options) the page's rows load up
+    front instead of lazily one row at a time.
+    """
     def decorator(f):
         @functools.wraps(f)
         def wrapped(*args, **kwargs):
@@ -19,43 +219,25 @@ def paginate(collection, version=None, max_per_page=25):
 
             # get ordering arguments
             order = request.args.get('order_by', 'created_at', type=str)
-            query = query.order_by(order)
-            # query = sort_query(query, order)
 
             # obtain pagination arguments from the URL's query string
-            page = request.args.get('page', 1, type=int)
             per_page = min(request.args.get('per_page', max_per_page, type=int), max_per_page)
             expanded = 1 if request.args.get('expanded', 0, type=int) != 0 else None
 
-            # run the query with Flask-SQLAlchemy's pagination
-            p = query.paginate(page, per_page)
-
-            # build the pagination metadata to include in the response
-            pages = {'page': page, 'per_page': per_page, 'total': p.total, 'pages': p.pages}
-
-            if p.has_prev:
-                pages['prev_url'] = url_for(
-                    request.endpoint, page=p.prev_num, per_page=per_page,
-                    expanded=expanded, _external=True, **kwargs)
-            else:
-                pages['prev_url'] = None
-
-            if p.has_next:
-                pages['next_url'] = url_for(
-                    request.endpoint, page=p.next_num, per_page=per_page,
-                    expanded=expanded, _external=True, **kwargs)
+            if cursor and 'cursor' in request.args:
+                items, pages = paginate_cursor(
+                    query, order, per_page, expanded, count=count, eager=eager, columns=cursor,
+                    **kwargs)
             else:
-                pages['next_url'] = None
-
-            pages['first_url'] = url_for(request.endpoint, page=1, per_page=per_page,
-                                         expanded=expanded, _external=True, **kwargs)
-            pages['last_url'] = url_for(request.endpoint, page=p.pages, per_page=per_page,
-                                        expanded=expanded, _external=True, **kwargs)
+                items, pages = paginate_pages(
+                    query, order, per_page, expanded, count=count, eager=eager, **kwargs)
 
-            results = [
-                _.export_data(request=request, **extra) for _ in p.items] if expanded else [
-                    _.get_url(request=request, **extra) for _ in p.items]
+            def results():
+                return {collection: [
+                    _.export_data(request=request, **extra) for _ in items] if expanded else [
+                        _.get_url(request=request, **extra) for _ in items], 'pages': pages}
 
-            return APIResult({collection: results, 'pages': pages})
+            etag = page_etag(items, pages) if conditional else None
+            return APIResult(results, etag=etag)
         return wrapped
     return decorator
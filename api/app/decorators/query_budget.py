@@ -0,0 +1,16 @@
+import functools
+from flask import g
+
+
+def query_budget(limit):
+    """
+    Most SQL statements a request to the endpoint may run, authentication
+    included, before it is logged (or fails with QUERY_BUDGET_STRICT)
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapped(*args, **kwargs):
+            g.query_budget = limit
+            return f(*args, **kwargs)
+        return wrapped
+    return decorator
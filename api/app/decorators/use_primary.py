@@ -0,0 +1,14 @@
+import functools
+from flask import g
+
+
+def use_primary(f):
+    """
+    Run every query of the request on the primary, for safe method endpoints
+    that write or must not read a lagging replica
+    """
+    @functools.wraps(f)
+    def wrapped(*args, **kwargs):
+        g.use_primary = True
+        return f(*args, **kwargs)
+    return wrapped
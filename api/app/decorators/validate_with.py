@@ -1,16 +1,28 @@
 import functools
 from voluptuous import Invalid
-from flask import request
+from flask import request, current_app
 
 from app.factory import APIException
+from app.validators import deferred_exist_checks, verify_exist_checks
 
 
 def validate_with(schema):
+    """
+    Validates the request json against a schema. UNIQUE_VALIDATION picks how Exist
+    checks run: one query each ("query"), one batched query ("batch") or, for
+    uniqueness, deferred to the database constraints ("constraint").
+    """
     def decorator(f):
         @functools.wraps(f)
         def wrapped(*args, **kwargs):
+            mode = current_app.config.get('UNIQUE_VALIDATION', 'batch')
             try:
-                schema(request.get_json())
+                if mode == 'query':
+                    schema(request.get_json())
+                else:
+                    with deferred_exist_checks() as checks:
+                        schema(request.get_json())
+                    verify_exist_checks(checks, unique=mode != 'constraint')
             except Invalid as e:
                 raise APIException("{} {}".format('.'.join(map(str, e.path)), e.msg), 409)
             return f(*args, **kwargs)
@@ -0,0 +1,60 @@
+"""
+JSON encoding backends for API responses. JSON_BACKEND picks one by name,
+"auto" takes the fastest installed C accelerated encoder and falls back to flask.
+"""
+from decimal import Decimal
+from flask import json
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+def flask_dumps(value):
+    return json.dumps(value)
+
+
+backends = {'flask': flask_dumps}
+
+try:
+    import orjson
+except ImportError:
+    pass
+else:
+    def orjson_dumps(value):
+        return orjson.dumps(value, default=_default)
+    backends['orjson'] = orjson_dumps
+
+try:
+    import rapidjson
+except ImportError:
+    pass
+else:
+    def rapidjson_dumps(value):
+        return rapidjson.dumps(value, default=_default, datetime_mode=rapidjson.DM_ISO8601)
+    backends['rapidjson'] = rapidjson_dumps
+
+try:
+    import ujson
+except ImportError:
+    pass
+else:
+    def ujson_dumps(value):
+        return ujson.dumps(value, ensure_ascii=False)
+    backends['ujson'] = ujson_dumps
+
+
+PREFERENCE = ('orjson', 'rapidjson', 'ujson', 'flask')
+
+
+def get_backend(name='auto'):
+    if name == 'auto':
+        name = next(_ for _ in PREFERENCE if _ in backends)
+    if name not in backends:
+        raise ValueError('JSON backend {} is not installed'.format(name))
+    return backends[name]
+
+
+dumps = get_backend()
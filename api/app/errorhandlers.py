@@ -1,57 +1,79 @@
-from flask import jsonify
+import re
+from flask import Response, current_app
+
+from app.extensions import db
+
+
+ERRORS = {
+    400: ('bad request', 'malformed request'),
+    401: ('unauthorized', 'unauthorized access'),
+    403: ('forbidden', 'forbidden access'),
+    404: ('not found', 'invalid resource URI'),
+    405: ('method not supported', 'method is not supported')
+}
+
+# the error bodies never change, encode them once per JSON backend
+BODIES = {}
+
+
+def error_body(status):
+    dumps = current_app.json_dumps
+    key = (dumps, status)
+    if key not in BODIES:
+        error, message = ERRORS[status]
+        BODIES[key] = dumps({'status': status, 'error': error, 'message': message})
+    return BODIES[key]
+
+
+def error_response(status):
+    return Response(error_body(status), status=status, mimetype='application/json')
 
 
 def bad_request(e):
-    response = jsonify({
-        'status': 400,
-        'error': 'bad request',
-        'message': 'malformed request'
-    })
-    response.status_code = 400
-    return response
+    return error_response(400)
 
 
 def unauthorized():
-    response = jsonify(
-        {
-            'status': 401,
-            'error': 'unauthorized',
-            'message': 'unauthorized access'
-        }
-    )
-    response.status_code = 401
-    return response
+    return error_response(401)
 
 
 def forbidden(e):
-    response = jsonify({
-        'status': 403,
-        'error': 'forbidden',
-        'message': 'forbidden access'
-    })
-    response.status_code = 403
-    return response
+    return error_response(403)
 
 
 def not_found(e):
-    response = jsonify({
-        'status': 404,
-        'error': 'not found',
-        'message': 'invalid resource URI'
-    })
-    response.status_code = 404
-    return response
+    return error_response(404)
 
 
 def method_not_supported(e):
-    response = jsonify({
-        'status': 405,
-        'error': 'method not supported',
-        'message': 'method is not supported'
-    })
-    response.status_code = 405
-    return response
+    return error_response(405)
 
 
 def conflict(e):
     return e.to_result()
+
+
+# postgres reports the violated constraint, sqlite only the columns
+SQLITE_UNIQUE = re.compile(r'UNIQUE constraint failed: \w+\.(\w+)')
+
+
+def unique_field(e):
+    constraint = getattr(getattr(e.orig, 'diag', None), 'constraint_name', None)
+    if constraint and constraint.startswith('uq_'):
+        for table in db.metadata.tables.values():
+            prefix = 'uq_{}_'.format(table.name)
+            if constraint.startswith(prefix) and constraint[len(prefix):] in table.columns:
+                return constraint[len(prefix):]
+
+    match = SQLITE_UNIQUE.search(str(e.orig))
+    return match.group(1) if match else None
+
+
+def integrity_error(e):
+    from app.factory import APIException
+
+    db.session.rollback()
+    field = unique_field(e)
+    if field is None:
+        raise e
+    return APIException('{} already exists in the database'.format(field), 409).to_result()
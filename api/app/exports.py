@@ -0,0 +1,48 @@
+import io
+import csv
+
+from app.awaremodel import export_plan, export_row
+from app.factory import APIStreamResult
+
+
+def stream_rows(model, query, batch=1000):
+    """
+    Exported columns only, fetched batch rows at a time through a server side
+    cursor so memory stays flat whatever the table size
+    """
+    columns = [getattr(model, key) for key, _ in export_plan(model)[0]]
+    return query.with_entities(*columns).order_by(model.id).yield_per(batch)
+
+
+def ndjson_lines(model, query, dumps, batch=1000):
+    for row in stream_rows(model, query, batch):
+        line = dumps(export_row(model, row))
+        yield (line.encode('utf-8') if isinstance(line, str) else line) + b'\n'
+
+
+def csv_lines(model, query, dumps=None, batch=1000):
+    keys = [key for key, _ in export_plan(model)[0]]
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=keys, lineterminator='\n')
+
+    writer.writeheader()
+    for row in stream_rows(model, query, batch):
+        writer.writerow(export_row(model, row))
+        if buffer.tell() > 65536:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def json_lines(model, query, dumps, batch=1000):
+    """One JSON object listing the rows under the table name, encoded a row at a time"""
+    rows = (export_row(model, row) for row in stream_rows(model, query, batch))
+    return APIStreamResult({}, model.__tablename__, rows).generate(dumps)
+
+
+FORMATS = {
+    'ndjson': ('application/x-ndjson', ndjson_lines),
+    'csv': ('text/csv', csv_lines),
+    'json': ('application/json', json_lines)
+}
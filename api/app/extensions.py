@@ -1,14 +1,19 @@
-from celery import Celery
-from sqlalchemy import MetaData
+import os
+import sys
+from flask import g
+from redis import StrictRedis
+from sqlalchemy import MetaData, orm
+from sqlalchemy.event import listens_for
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import Pool, NullPool
 
-from flask_sqlalchemy import SQLAlchemy, BaseQuery
-from flask_migrate import Migrate
+from flask_sqlalchemy import SQLAlchemy as BaseSQLAlchemy, BaseQuery
 from flask_bcrypt import Bcrypt
-from flask_cors import CORS
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from flask_bouncer import Bouncer
 
-from app.config import Base
+from app.metrics import InstrumentedQueuePool
+from app.replicas import ReplicaSet, RoutingSession
 
 
 convention = {
@@ -21,24 +26,174 @@ convention = {
 
 
 class ActiveQuery(BaseQuery):
-    def all(self):
-        return list(self.from_self().filter_by(active=True))
+    """
+    Query returning only active rows, the filter is added when the query compiles
+    so every loading method sees it, without wrapping the query in a subquery
+    """
+    _with_inactive = False
+
+    def with_inactive(self):
+        query = self._clone()
+        query._with_inactive = True
+        return query
+
+    def get(self, ident):
+        # rows already in the identity map are returned without compiling a query
+        obj = BaseQuery.get(self, ident)
+        if obj is not None and not self._with_inactive and \
+                getattr(obj, 'active', None) is False:
+            return None
+        return obj
+
+
+@listens_for(ActiveQuery, 'before_compile', retval=True)
+def filter_active(query):
+    # relationship loads and refreshes of already loaded rows are left alone
+    if query._with_inactive or query.lazy_loaded_from is not None or \
+            query._refresh_state is not None:
+        return query
+
+    for description in query.column_descriptions:
+        active = getattr(description['entity'], 'active', None)
+        if active is not None:
+            # the bare column, so the WHERE matches the partial indexes' predicate
+            query = query.enable_assertions(False).filter(active)
+    return query
+
+
+class Redis(object):
+    """Redis client bound to the application REDIS_URI"""
+    def __init__(self):
+        self.client = None
+
+    def init_app(self, app):
+        # without a REDIS_URI the cache helpers are no-ops
+        if not app.config.get('REDIS_URI'):
+            self.client = None
+            return
+        self.client = StrictRedis.from_url(
+            app.config['REDIS_URI'], socket_timeout=app.config.get('REDIS_SOCKET_TIMEOUT'),
+            socket_connect_timeout=app.config.get('REDIS_SOCKET_TIMEOUT'))
+
+    def reset(self):
+        # sockets a forked child inherited are the parent's, reconnect on first use
+        if self.client is not None:
+            self.client.connection_pool.reset()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """
+    Engines built from the DB_* settings: an instrumented, sized and recycled
+    pool, or no pool at all behind PgBouncer in transaction mode where every
+    checkout is a fresh client connection and session state does not survive.
+    DB_REPLICA_URIS become the binds replica0, replica1... read by RoutingSession
+    """
+    def init_app(self, app):
+        uris = app.config.get('DB_REPLICA_URIS')
+        if uris:
+            keys = ['replica{}'.format(i) for i, _ in enumerate(uris)]
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds.update(zip(keys, uris))
+            app.config['SQLALCHEMY_BINDS'] = binds
+            app.extensions['replicas'] = ReplicaSet(
+                app, keys, app.config.get('DB_REPLICA_MAX_LAG', 5),
+                app.config.get('DB_REPLICA_CHECK_INTERVAL', 5))
+            app.before_request(self.reset_routing)
+        BaseSQLAlchemy.init_app(self, app)
+
+    def reset_routing(self):
+        # a session or g outliving the request (e.g. under tests) starts over on the replicas
+        g.pop('use_primary', None)
+        self.session().reset_routing()
+
+    def primary(self):
+        """Context whose reads go to the primary, e.g. those filling a cache"""
+        return self.session().primary()
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        BaseSQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername == 'sqlite':
+            return
+
+        config = app.config
+        if config.get('DB_PGBOUNCER'):
+            # psycopg2 never prepares statements server side, a pool is all to drop
+            options['poolclass'] = NullPool
+        else:
+            options.setdefault('poolclass', InstrumentedQueuePool)
+            options.setdefault('pool_size', config.get('DB_POOL_SIZE', 5))
+            options.setdefault('max_overflow', config.get('DB_MAX_OVERFLOW', 10))
+            options.setdefault('pool_timeout', config.get('DB_POOL_TIMEOUT', 30))
+            options.setdefault('pool_recycle', config.get('DB_POOL_RECYCLE', -1))
+            options.setdefault('pool_pre_ping', config.get('DB_POOL_PRE_PING', False))
+
+            # startup parameters are rejected by PgBouncer, set the timeout on its role
+            timeout = config.get('DB_STATEMENT_TIMEOUT')
+            if timeout:
+                connect_args = options.setdefault('connect_args', {})
+                connect_args['options'] = '{} -c statement_timeout={}'.format(
+                    connect_args.get('options', ''), int(timeout)).strip()
+
+
+@listens_for(Pool, 'connect')
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@listens_for(Pool, 'checkout')
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    # a connection inherited through fork is shared with the parent, never reuse it
+    if connection_record.info.get('pid', os.getpid()) != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise DisconnectionError('connection belongs to process {}, this is {}'.format(
+            connection_record.info['pid'], os.getpid()))
+
+
+def dispose_engines(app):
+    """Drop connections a forked child inherited, call once as the child starts"""
+    with app.app_context():
+        for bind in [None] + list(app.config.get('SQLALCHEMY_BINDS') or ()):
+            db.get_engine(app, bind).dispose()
+
+
+def reset_connections(app):
+    """Database engines, redis and broker clients reconnected after a fork"""
+    dispose_engines(app)
+    redis_store.reset()
+    queues = app.extensions.get('celery_queues')
+    if queues is not None:
+        queues.client.connection_pool.reset()
 
 
 # instantiate the extension
 db = SQLAlchemy(query_class=ActiveQuery, metadata=MetaData(naming_convention=convention))
-migrate = Migrate()
 bcrypt = Bcrypt()
 auth = HTTPBasicAuth()
 token = HTTPTokenAuth()
 bouncer = Bouncer()
-celery = Celery(__name__, broker=Base.CELERY_BROKER_URL)
+redis_store = Redis()
 
 
 def init_extensions(app):
     db.init_app(app)
-    migrate.init_app(app, db)
     bcrypt.init_app(app)
+    redis_store.init_app(app)
+
+    # Flask-Migrate imports alembic, only the flask db commands use it and the CLI
+    # has imported it with them by the time it builds the app
+    if 'flask_migrate' in sys.modules or not app.config.get('LAZY_INIT'):
+        from flask_migrate import Migrate
+        Migrate(app, db)
+
+
+def init_request_extensions(app):
+    """Extensions only requests use, initialised with the views"""
+    from flask_cors import CORS
     CORS(app, supports_credentials=True)
     bouncer.init_app(app)
-    celery.conf.update(app.config)
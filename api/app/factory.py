@@ -1,28 +1,86 @@
 import os
-from flask import Flask, Response, json
-from flask_bouncer import Unauthorized as Forbidden
+import threading
+from flask import Flask, Response, current_app, request, stream_with_context
+from sqlalchemy.exc import IntegrityError
 
 from app.config import config
-from app.extensions import init_extensions
+from app.extensions import init_extensions, init_request_extensions
+from app.encoders import get_backend
+from app.instrumentation import init_instrumentation
+from app.metrics import init_metrics
 from app.errorhandlers import (
-    bad_request, forbidden, not_found, method_not_supported, conflict)
+    bad_request, forbidden, not_found, method_not_supported, conflict, integrity_error)
 
 
 class APIResult():
     """
-    Transform flask result into json formatted response
+    Transform flask result into json formatted response.
+
+    With an etag (sent weak) or last_modified, a GET whose If-None-Match or
+    If-Modified-Since still holds gets a 304 and a callable value is never called.
     """
-    def __init__(self, value, status=200, **headers):
+    def __init__(self, value, status=200, etag=None, last_modified=None, **headers):
         self.value = value
         self.status = status
+        self.etag = etag
+        self.last_modified = last_modified
         self.headers = headers
 
-    def to_response(self):
-        rv = Response(json.dumps(self.value), status=self.status,
-                      mimetype='application/json')
+    def is_fresh(self):
+        if request.method not in ('GET', 'HEAD') or self.status != 200:
+            return False
+        if self.etag is not None and request.if_none_match:
+            return request.if_none_match.contains_weak(self.etag)
+        if self.last_modified is not None and request.if_modified_since:
+            since = request.if_modified_since.replace(tzinfo=None)
+            return self.last_modified.replace(microsecond=0, tzinfo=None) <= since
+        return False
+
+    def finalize(self, rv):
         rv.headers.extend(self.headers)
+        if self.etag is not None:
+            rv.set_etag(self.etag, weak=True)
+        if self.last_modified is not None:
+            rv.last_modified = self.last_modified
         return rv
 
+    def not_modified(self):
+        return self.finalize(Response(status=304))
+
+    def to_response(self):
+        value = self.value() if callable(self.value) else self.value
+        rv = Response(current_app.json_dumps(value), status=self.status,
+                      mimetype='application/json')
+        return self.finalize(rv)
+
+
+def _to_bytes(value):
+    return value.encode('utf-8') if isinstance(value, str) else value
+
+
+class APIStreamResult(APIResult):
+    """
+    Stream a JSON object whose collection key is filled from an iterable,
+    items are encoded and sent one at a time after the rest of the envelope
+    """
+    def __init__(self, value, key, items, status=200, **headers):
+        APIResult.__init__(self, value, status=status, **headers)
+        self.key = key
+        self.items = items
+
+    def generate(self, dumps):
+        yield b'{' + _to_bytes(dumps(self.key)) + b':['
+        for index, item in enumerate(self.items):
+            yield (b',' if index else b'') + _to_bytes(dumps(item))
+
+        rest = _to_bytes(dumps(self.value))
+        yield b']' + (b',' + rest[1:] if len(rest) > 2 else b'}')
+
+    def to_response(self):
+        rv = Response(stream_with_context(self.generate(current_app.json_dumps)),
+                      status=self.status, mimetype='application/json')
+        return self.finalize(rv)
+
 
 class APIException(Exception):
     """
@@ -42,11 +100,44 @@ class APIException(Exception):
 
 class APIFlask(Flask):
     """
-    Extend flask to handle APIResult while making response
+    Extend flask to handle APIResult while making response, and run setup
+    deferred by create_app (see LAZY_INIT) before the URL map is first used,
+    by the first request or a url_for outside of one
     """
+    json_dumps = staticmethod(get_backend('flask'))
+
+    def __init__(self, *args, **kwargs):
+        Flask.__init__(self, *args, **kwargs)
+        self.deferred = []
+        self.deferred_loaded = False
+        self.deferred_lock = threading.RLock()
+
+    def defer(self, f):
+        """Call f(app) before the URL map is first used"""
+        self.deferred.append(f)
+
+    def load_deferred(self):
+        if self.deferred_loaded:
+            return
+        # concurrent first requests wait here until the routes are complete,
+        # an initializer is only dropped once it returned
+        with self.deferred_lock:
+            if self.deferred_loaded:
+                return
+            while self.deferred:
+                self.deferred[0](self)
+                self.deferred.pop(0)
+            self.deferred_loaded = True
+
+    def create_url_adapter(self, request):
+        # without a request the adapter is only built when SERVER_NAME is set
+        if not self.deferred_loaded and (request is not None or self.config['SERVER_NAME']):
+            self.load_deferred()
+        return Flask.create_url_adapter(self, request)
+
     def make_response(self, rv):
         if isinstance(rv, APIResult):
-            return rv.to_response()
+            return rv.not_modified() if rv.is_fresh() else rv.to_response()
         return Flask.make_response(self, rv)
 
 
@@ -59,20 +150,47 @@ def create_app(mode=os.environ.get('FLASK_MODE', 'app.config.Development')):
     app_config = config.get(mode)
     app.config.from_object(app_config)
     app_config().init_app(app)
+    app.json_dumps = get_backend(app.config.get('JSON_BACKEND', 'auto'))
 
     # initialize all extensions
     init_extensions(app)
+    init_instrumentation(app)
+    init_metrics(app)
+    init_commands(app)
 
-    # register blueprints
-    # add blueprint registration statements here
-    from app.users import users
-    app.register_blueprint(users)
+    # import every model, the metadata is complete even before the views load
+    from app.users import models    # NOQA
 
     # register error handlers
     app.register_error_handler(400, bad_request)
-    app.register_error_handler(Forbidden, forbidden)
     app.register_error_handler(404, not_found)
     app.register_error_handler(405, method_not_supported)
     app.register_error_handler(APIException, conflict)
+    app.register_error_handler(IntegrityError, integrity_error)
 
+    app.defer(init_views)
+    if not app.config.get('LAZY_INIT'):
+        app.load_deferred()
     return app
+
+
+def init_views(app):
+    """
+    Blueprints with the extensions serving them, their imports (models, schemas,
+    authorization rules) are the bulk of what building the app costs
+    """
+    from flask_bouncer import Unauthorized as Forbidden
+    init_request_extensions(app)
+    app.register_error_handler(Forbidden, forbidden)
+
+    # register blueprints, with the modules adding their routes
+    # add blueprint registration statements here
+    from app.users import users, routes    # NOQA
+    app.register_blueprint(users)
+
+
+def init_commands(app):
+    # also found through the flask.commands entry points without building the app
+    from app.commands import commands
+    for command in commands:
+        app.cli.add_command(command)
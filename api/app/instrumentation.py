@@ -0,0 +1,100 @@
+import time
+from collections import Counter
+from flask import g, current_app, request, has_request_context
+from sqlalchemy.engine import Engine
+from sqlalchemy.event import listens_for
+
+
+class QueryBudgetExceeded(Exception):
+    """Raised instead of logged when QUERY_BUDGET_STRICT is set, e.g. under tests"""
+
+
+class NPlusOneDetected(QueryBudgetExceeded):
+    """The same statement ran row after row within one request"""
+
+
+class QueryStats(object):
+    """SQL statements run and time spent in the database during one request"""
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = []
+        self.started = time.monotonic()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements.append(statement)
+
+    def repeated(self, threshold):
+        """
+        SELECTs run threshold times or more with only their parameters changing,
+        the trace lazy loading a relationship row after row leaves
+        """
+        counts = Counter(_ for _ in self.statements if _.lstrip().upper().startswith('SELECT'))
+        return [(statement, count) for statement, count in counts.items() if count >= threshold]
+
+
+@listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql' in g:
+        conn.info.setdefault('query_started', []).append(time.monotonic())
+
+
+@listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('query_started')
+    if started and has_request_context() and 'sql' in g:
+        g.sql.record(statement, time.monotonic() - started.pop())
+
+
+def budget():
+    """The view's query_budget, else QUERY_BUDGETS[endpoint], else QUERY_BUDGET"""
+    if 'query_budget' in g:
+        return g.query_budget
+    budgets = current_app.config.get('QUERY_BUDGETS') or {}
+    return budgets.get(request.endpoint, current_app.config.get('QUERY_BUDGET'))
+
+
+def start_request():
+    # g outlives the request when the app context does, e.g. under tests
+    g.pop('query_budget', None)
+    g.sql = QueryStats()
+
+
+def finish_request(rv):
+    stats = g.pop('sql', None)
+    if stats is None:
+        return rv
+
+    if current_app.config.get('SERVER_TIMING'):
+        total = (time.monotonic() - stats.started) * 1000
+        rv.headers.add('Server-Timing', 'db;dur={:.1f};desc="{} queries", app;dur={:.1f}'
+                       .format(stats.duration * 1000, stats.count, total))
+
+    strict = current_app.config.get('QUERY_BUDGET_STRICT')
+    threshold = current_app.config.get('N_PLUS_ONE_THRESHOLD')
+    repeated = stats.repeated(threshold) if threshold else []
+    if repeated:
+        message = '{} {} may be N+1, eager load what these statements fetch:\n{}'.format(
+            request.method, request.endpoint, '\n'.join(
+                '{} times: {}'.format(count, ' '.join(statement.split()))
+                for statement, count in repeated))
+        if strict:
+            raise NPlusOneDetected(message)
+        current_app.logger.warning(message)
+
+    # queries of a streamed body run after this hook and are not counted
+    limit = budget()
+    if limit is not None and stats.count > limit:
+        message = '{} {} ran {} queries, budget is {}'.format(
+            request.method, request.endpoint, stats.count, limit)
+        if strict:
+            raise QueryBudgetExceeded('{}:\n{}'.format(message, '\n'.join(stats.statements)))
+        current_app.logger.warning(message)
+    return rv
+
+
+def init_instrumentation(app):
+    app.before_request(start_request)
+    app.after_request(finish_request)
@@ -0,0 +1,218 @@
+import json
+import time
+import base64
+import threading
+import http.client
+from itertools import count
+from urllib.parse import urlsplit
+from collections import OrderedDict, defaultdict
+
+
+BUCKETS = tuple(0.001 * 2 ** _ for _ in range(14))
+
+
+class WSGITarget(object):
+    """Calls the application in process, one test client per worker thread"""
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def request(self, method, path, headers=None, body=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        rv = client.open(path, method=method, headers=headers, data=body,
+                         content_type='application/json')
+        return rv.status_code, rv.get_data()
+
+
+class HTTPTarget(object):
+    """Talks HTTP to a running server, one keep-alive connection per worker thread"""
+    def __init__(self, url, timeout=30):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.prefix = parts.path.rstrip('/')
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def request(self, method, path, headers=None, body=None):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout)
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        try:
+            connection.request(method, self.prefix + path, body=body, headers=headers)
+            rv = connection.getresponse()
+            return rv.status, rv.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self.local.connection = None
+            raise
+
+
+class Session(object):
+    """Credentials and ids the scenarios need, obtained once before the run"""
+    def __init__(self, target, username, password):
+        basic = base64.b64encode('{}:{}'.format(username, password).encode('utf-8'))
+        self.basic = {'Authorization': 'Basic {}'.format(basic.decode('ascii'))}
+        status, body = target.request('GET', '/users/token', self.basic)
+        if status != 200:
+            raise RuntimeError(
+                'could not obtain a token, the server answered {}'.format(status))
+        self.bearer = {'Authorization': 'Bearer {}'.format(json.loads(body)['token'])}
+
+        status, body = target.request('GET', '/users/?per_page=1', self.bearer)
+        urls = json.loads(body)['users'] if status == 200 else []
+        self.read_path = urlsplit(urls[0]).path if urls else '/users/1'
+        self.created = count()
+        self.stamp = int(time.time())
+
+
+def issue_token(target, session):
+    return target.request('GET', '/users/token', session.basic)
+
+
+def read(target, session):
+    return target.request('GET', session.read_path, session.bearer)
+
+
+def list_urls(target, session):
+    return target.request('GET', '/users/', session.bearer)
+
+
+def list_expanded(target, session):
+    return target.request('GET', '/users/?expanded=1', session.bearer)
+
+
+def create(target, session):
+    # the batch endpoint authenticates the token, POST /users/ is registration
+    name = 'load{}x{}'.format(session.stamp, next(session.created))
+    body = json.dumps([{'username': name, 'email': '{}@loadtest.test'.format(name),
+                        'password': 'loadtest'}])
+    return target.request('POST', '/users/batch', session.bearer, body)
+
+
+SCENARIOS = OrderedDict([
+    ('token', issue_token),
+    ('read', read),
+    ('list', list_urls),
+    ('list-expanded', list_expanded),
+    ('create', create)
+])
+
+
+def parse_mix(mix):
+    """'read=5,list=1' into a weighted round robin of scenario names"""
+    weights = OrderedDict()
+    for part in (mix or ','.join(SCENARIOS)).split(','):
+        name, _, weight = part.strip().partition('=')
+        if name not in SCENARIOS:
+            raise ValueError('unknown scenario {}, pick from {}'.format(
+                name, ', '.join(SCENARIOS)))
+        weights[name] = int(weight or 1)
+    return [name for name, weight in weights.items() for _ in range(weight)]
+
+
+def percentile(latencies, p):
+    """Nearest rank percentile of sorted latencies"""
+    if not latencies:
+        return None
+    rank = int(round(p / 100.0 * len(latencies))) - 1
+    return latencies[min(len(latencies) - 1, max(0, rank))]
+
+
+def histogram(latencies):
+    counts = [0] * (len(BUCKETS) + 1)
+    for latency in latencies:
+        counts[next((i for i, le in enumerate(BUCKETS) if latency <= le), len(BUCKETS))] += 1
+    return [{'le': le, 'count': c} for le, c in zip(BUCKETS + ('+Inf',), counts)]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    requests = len(latencies)
+    return OrderedDict([
+        ('requests', requests),
+        ('errors', errors),
+        ('error_rate', errors / requests if requests else 0.0),
+        ('throughput', requests / elapsed if elapsed else 0.0),
+        ('p50', percentile(latencies, 50)),
+        ('p95', percentile(latencies, 95)),
+        ('p99', percentile(latencies, 99)),
+        ('max', latencies[-1] if latencies else None),
+        ('histogram', histogram(latencies))
+    ])
+
+
+def run(target, session, mix, concurrency=10, rate=None, duration=10.0, requests=None):
+    """
+    Drive the scenarios from concurrency threads until duration seconds or
+    requests requests have passed. With a rate, requests are scheduled at fixed
+    intervals and latency counts from the scheduled time, so a stalled server
+    shows up in the percentiles instead of silently lowering the offered load.
+    """
+    latencies, errors, statuses = defaultdict(list), defaultdict(int), defaultdict(int)
+    lock = threading.Lock()
+    ticket = count()
+    started = time.monotonic()
+    deadline = started + duration if duration else None
+
+    def worker():
+        while True:
+            index = next(ticket)
+            if requests is not None and index >= requests:
+                return
+            scheduled = started + index / rate if rate else time.monotonic()
+            if deadline is not None and scheduled >= deadline:
+                return
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            name = mix[index % len(mix)]
+            try:
+                status, _ = SCENARIOS[name](target, session)
+            except Exception:
+                status = None
+            latency = time.monotonic() - scheduled
+
+            with lock:
+                latencies[name].append(latency)
+                statuses['{}'.format(status)] += 1
+                if status is None or status >= 400:
+                    errors[name] += 1
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    everything = [latency for values in latencies.values() for latency in values]
+    return OrderedDict([
+        ('concurrency', concurrency),
+        ('rate', rate),
+        ('elapsed', elapsed),
+        ('statuses', dict(statuses)),
+        ('total', summarize(everything, sum(errors.values()), elapsed)),
+        ('scenarios', OrderedDict(
+            (name, summarize(latencies[name], errors[name], elapsed))
+            for name in SCENARIOS if name in latencies))
+    ])
+
+
+def report(results):
+    """Text table of the results, latencies in milliseconds"""
+    def ms(value):
+        return '-' if value is None else '{:.1f}'.format(value * 1000)
+
+    lines = ['{:<14} {:>8} {:>8} {:>9} {:>8} {:>8} {:>8} {:>8}'.format(
+        'scenario', 'requests', 'errors', 'req/s', 'p50', 'p95', 'p99', 'max')]
+    rows = list(results['scenarios'].items()) + [('total', results['total'])]
+    for name, stats in rows:
+        lines.append('{:<14} {:>8} {:>7.1%} {:>9.1f} {:>8} {:>8} {:>8} {:>8}'.format(
+            name, stats['requests'], stats['error_rate'], stats['throughput'],
+            ms(stats['p50']), ms(stats['p95']), ms(stats['p99']), ms(stats['max'])))
+    return '\n'.join(lines)
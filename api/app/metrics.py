@@ -0,0 +1,148 @@
+"""
+Prometheus metrics. Under gunicorn every worker writes its samples to the
+directory named by the prometheus_multiproc_dir environment variable, which
+must be set (and emptied) before the workers start; /metrics then aggregates
+the files of all workers whichever of them answers the scrape.
+"""
+import os
+import time
+from flask import g, request, current_app, Response
+from redis import StrictRedis, RedisError
+from sqlalchemy.pool import QueuePool
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+
+MULTIPROCESS = bool(os.environ.get('prometheus_multiproc_dir'))
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Request latency by endpoint',
+    ['endpoint', 'method', 'status'])
+REQUEST_ERRORS = Counter(
+    'http_request_exceptions_total', 'Requests ending with an unhandled exception',
+    ['endpoint', 'method'])
+IN_PROGRESS = Gauge(
+    'http_requests_in_progress', 'Requests being served', multiprocess_mode='livesum')
+
+POOL_CHECKED_OUT = Gauge(
+    'db_pool_checked_out', 'Connections checked out of the pool', multiprocess_mode='livesum')
+POOL_OVERFLOW = Gauge(
+    'db_pool_overflow', 'Connections opened beyond pool_size', multiprocess_mode='livesum')
+POOL_WAIT = Histogram(
+    'db_pool_wait_seconds', 'Time spent waiting for a pooled connection',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+
+REPLICA_LAG = Gauge(
+    'db_replica_lag_seconds', 'Replication lag at the last probe, -1 when unreachable',
+    ['replica'], multiprocess_mode='max')
+REPLICA_HEALTHY = Gauge(
+    'db_replica_healthy', 'Whether reads are routed to the replica',
+    ['replica'], multiprocess_mode='min')
+
+BCRYPT_VERIFY = Histogram(
+    'bcrypt_verify_seconds', 'Password hash verification time',
+    buckets=(0.01, 0.05, 0.1, 0.2, 0.3, 0.5, 1, 2))
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool reporting its usage and how long each checkout waits for a connection"""
+    def _do_get(self):
+        started = time.monotonic()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            POOL_WAIT.observe(time.monotonic() - started)
+            self.report()
+
+    def _do_return_conn(self, conn):
+        QueuePool._do_return_conn(self, conn)
+        self.report()
+
+    def report(self):
+        POOL_CHECKED_OUT.set(self.checkedout())
+        POOL_OVERFLOW.set(max(self.overflow(), 0))
+
+
+class CeleryQueues(object):
+    """Broker queue depths read from redis when scraped"""
+    def __init__(self, url, queues, timeout=None):
+        self.client = StrictRedis.from_url(url, socket_timeout=timeout,
+                                           socket_connect_timeout=timeout)
+        self.queues = queues
+
+    def collect(self):
+        depth = GaugeMetricFamily(
+            'celery_queue_length', 'Tasks waiting in the broker queue', labels=['queue'])
+        try:
+            with self.client.pipeline(transaction=False) as pipe:
+                for queue in self.queues:
+                    pipe.llen(queue)
+                lengths = pipe.execute()
+        except RedisError:
+            return []
+        for queue, length in zip(self.queues, lengths):
+            depth.add_metric([queue], length)
+        return [depth]
+
+
+def endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def start_request():
+    g.metrics_started = time.monotonic()
+    IN_PROGRESS.inc()
+
+
+def record_status(rv):
+    g.metrics_status = rv.status_code
+    return rv
+
+
+def finish_request(exc=None):
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return
+    IN_PROGRESS.dec()
+    if exc is not None:
+        REQUEST_ERRORS.labels(endpoint(), request.method).inc()
+    status = g.pop('metrics_status', 500)
+    REQUEST_LATENCY.labels(endpoint(), request.method, status).observe(
+        time.monotonic() - started)
+
+
+def metrics():
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    queues = current_app.extensions.get('celery_queues')
+    output = generate_latest(registry)
+    if queues is not None:
+        # scraped once per request, never part of the per process sample files
+        scratch = CollectorRegistry()
+        scratch.register(queues)
+        output += generate_latest(scratch)
+    return Response(output, mimetype=CONTENT_TYPE_LATEST)
+
+
+def mark_process_dead(pid):
+    """Call from gunicorn's child_exit so live gauges drop an exited worker"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid)
+
+
+def init_metrics(app):
+    if not app.config.get('METRICS', True):
+        return
+    queues = app.config.get('METRICS_CELERY_QUEUES')
+    if queues and app.config.get('CELERY_BROKER_URL', '').startswith('redis'):
+        app.extensions['celery_queues'] = CeleryQueues(
+            app.config['CELERY_BROKER_URL'], queues, app.config.get('REDIS_SOCKET_TIMEOUT'))
+
+    app.before_request(start_request)
+    app.after_request(record_status)
+    app.teardown_request(finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,122 @@
+import time
+import threading
+from itertools import count
+from contextlib import contextmanager
+from flask import g, request, has_request_context
+from flask_sqlalchemy import SignallingSession, get_state
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql import Select, text
+
+from app.metrics import REPLICA_LAG, REPLICA_HEALTHY
+
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# seconds the replica is behind, nothing when it has replayed all it received
+LAG = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() "
+    "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END")
+
+
+class ReplicaSet(object):
+    """
+    Read replicas configured as binds, each probed at most every check_interval
+    seconds. A replica that fails the probe or lags more than max_lag seconds is
+    skipped until a later probe finds it healthy again.
+    """
+    def __init__(self, app, keys, max_lag=5, check_interval=5):
+        self.app = app
+        self.keys = keys
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.status = {key: (True, 0.0) for key in keys}
+        self.lock = threading.Lock()
+        self.turn = count()
+
+    def engine(self, key):
+        return get_state(self.app).db.get_engine(self.app, bind=key)
+
+    def check(self, key):
+        engine = self.engine(key)
+        try:
+            with engine.connect() as connection:
+                lag = float(connection.execute(LAG).scalar() or 0) \
+                    if engine.dialect.name == 'postgresql' else 0.0
+        except SQLAlchemyError:
+            lag = None
+
+        healthy = lag is not None and lag <= self.max_lag
+        REPLICA_LAG.labels(key).set(-1 if lag is None else lag)
+        REPLICA_HEALTHY.labels(key).set(int(healthy))
+        return healthy
+
+    def healthy(self):
+        now = time.monotonic()
+        with self.lock:
+            stale = [key for key, (_, checked) in self.status.items()
+                     if now - checked >= self.check_interval]
+            for key in stale:
+                # claimed before probing so concurrent requests don't probe too
+                self.status[key] = (self.status[key][0], now)
+        for key in stale:
+            self.status[key] = (self.check(key), now)
+        return [key for key in self.keys if self.status[key][0]]
+
+    def pick(self):
+        """Engine of the next healthy replica round robin, None to fall back on the primary"""
+        keys = self.healthy()
+        return self.engine(keys[next(self.turn) % len(keys)]) if keys else None
+
+
+class RoutingSession(SignallingSession):
+    """
+    Sends reads of safe method requests to a replica, everything else to the
+    primary. Once the request writes, flushes or asks for the primary its later
+    reads stay there, so it reads its own writes. Reads within primary() go to
+    the primary too, for lookups kept in a cache beyond the request.
+    """
+    def __init__(self, db, **options):
+        SignallingSession.__init__(self, db, **options)
+        self.reset_routing()
+
+    def reset_routing(self):
+        self._on_primary = False
+        self._replica = None
+        self._pinned = 0
+
+    def use_primary(self):
+        self._on_primary = True
+
+    @contextmanager
+    def primary(self):
+        self._pinned += 1
+        try:
+            yield self
+        finally:
+            self._pinned -= 1
+
+    def reads_replica(self, mapper, clause):
+        if mapper is not None and getattr(mapper.mapped_table, 'info', {}).get('bind_key'):
+            return False
+        if not isinstance(clause, Select) or clause._for_update_arg is not None:
+            return False
+        return has_request_context() and request.method in SAFE_METHODS and \
+            not g.get('use_primary', False)
+
+    def get_bind(self, mapper=None, clause=None):
+        replicas = self.app.extensions.get('replicas')
+        if self._flushing:
+            self._on_primary = True
+        if replicas is None or self._on_primary or self._pinned:
+            return SignallingSession.get_bind(self, mapper, clause)
+
+        if not self.reads_replica(mapper, clause):
+            # a write, a locking read or a statement we can't tell apart
+            self._on_primary = clause is not None or mapper is not None
+            return SignallingSession.get_bind(self, mapper, clause)
+
+        if self._replica is None:
+            # one replica for the whole request so its reads are consistent
+            self._replica = replicas.pick() or False
+        return self._replica or SignallingSession.get_bind(self, mapper, clause)
@@ -0,0 +1,121 @@
+import random
+import string
+import bcrypt as pybcrypt
+from datetime import datetime, timedelta
+from sqlalchemy import func
+
+from app.extensions import db
+from app.awaremodel import User
+from app.users.models import RevokedToken
+from app.users.bulk import complete_rows, copy_rows
+from app.cache import table_changed
+
+
+EPOCH = datetime(2018, 1, 1)
+SPAN = 3 * 365 * 24 * 3600
+BCRYPT_ALPHABET = './' + string.ascii_uppercase + string.ascii_lowercase + string.digits
+
+
+def constant(rng, mean):
+    return int(mean)
+
+
+def uniform(rng, mean):
+    return rng.randint(0, int(2 * mean))
+
+
+def exponential(rng, mean):
+    return int(rng.expovariate(1.0 / mean)) if mean else 0
+
+
+def pareto(rng, mean, alpha=1.5):
+    # long tail, most users revoke little and a few revoke a lot
+    return int((rng.paretovariate(alpha) - 1) * mean * (alpha - 1)) if mean else 0
+
+
+DISTRIBUTIONS = {
+    'constant': constant,
+    'uniform': uniform,
+    'exponential': exponential,
+    'pareto': pareto
+}
+
+
+def seeded_hash(rng, password, rounds=12):
+    """bcrypt hash computed once with a salt drawn from rng, so reruns store identical rows"""
+    salt = ''.join(rng.choice(BCRYPT_ALPHABET) for _ in range(21)) + rng.choice('.Oeu')
+    salt = '$2b${:02d}${}'.format(rounds, salt).encode('ascii')
+    return pybcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def insert(model, rows):
+    """COPY on PostgreSQL, executemany elsewhere"""
+    table = model.__table__
+    keys = sorted(rows[0])
+    rows = complete_rows(table, rows, keys)
+    if db.session.get_bind().dialect.name == 'postgresql':
+        copy_rows(table, keys, rows)
+    else:
+        db.session.execute(table.insert(), rows)
+
+
+def reset_sequence(model):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        table = model.__tablename__
+        db.session.execute(
+            "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+            "(SELECT max(id) FROM {0}))".format(table))
+
+
+def seed(users, tokens=0, distribution='constant', seed=0, password='password',
+         password_hash=None, rounds=12, batch=10000, echo=print):
+    """
+    Generate users and their revoked tokens in batches. Every value comes from
+    one random.Random(seed) stream so the same arguments give the same dataset.
+    Returns the number of users and tokens inserted.
+    """
+    rng = random.Random(seed)
+    draw = DISTRIBUTIONS[distribution]
+    password_hash = password_hash or seeded_hash(rng, password, rounds)
+    # soft deleted users keep their ids, start after them
+    start = (db.session.query(func.max(User.id)).with_inactive().scalar() or 0) + 1
+    total_tokens = 0
+
+    for offset in range(0, users, batch):
+        user_rows, token_rows = [], []
+        for id in range(start + offset, start + min(offset + batch, users)):
+            created_at = EPOCH + timedelta(seconds=rng.randrange(SPAN))
+            count = draw(rng, tokens)
+            user_rows.append({
+                'id': id,
+                'username': 'user{}'.format(id),
+                'email': 'user{}@seed.test'.format(id),
+                'password': password_hash,
+                'active': True,
+                'created_at': created_at,
+                'modified_at': created_at,
+                'confirmed_at': created_at,
+                'revoked_token_count': count
+            })
+            for _ in range(count):
+                revoked_at = created_at + timedelta(seconds=rng.randrange(SPAN))
+                token_rows.append({
+                    'user_id': id,
+                    'token': '{:032x}'.format(rng.getrandbits(128)),
+                    'active': True,
+                    'created_at': revoked_at,
+                    'modified_at': revoked_at
+                })
+
+        insert(User, user_rows)
+        if token_rows:
+            insert(RevokedToken, token_rows)
+        db.session.commit()
+        total_tokens += len(token_rows)
+        echo('{} users, {} revoked tokens'.format(offset + len(user_rows), total_tokens))
+
+    reset_sequence(User)
+    db.session.commit()
+    table_changed(User.__tablename__)
+    table_changed(RevokedToken.__tablename__)
+    return users, total_tokens
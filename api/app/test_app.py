@@ -1,13 +1,18 @@
 import json
+import time
+import random
 import pytest
+import threading
 from flask import url_for
 
 from app import app
-from app import test as tst, initdb
-from app.factory import APIResult, APIException
+from app.commands import test as tst, initdb, load_test
+from app.factory import create_app, APIResult, APIStreamResult, APIException
 from app.awaremodel import User
-from app.countries.models import Country
-from app.telcos.models import Telco
+from app.cache import generation, table_changed
+from app.counting import count_rows, EXACT, CACHED, ESTIMATE
+from app.seed import seed, seeded_hash
+from app.users.models import RevokedToken
 
 
 @pytest.mark.usefixtures('client_class')
@@ -18,6 +23,69 @@ class TestApp:
             config['DB_USER'], config['DB_PASS'], config['DB_PORT'], config['DB']
         )
 
+    def test_engine_pool(self, app, db):
+        pool = db.engine.pool
+        assert pool.size() == app.config['DB_POOL_SIZE']
+        assert pool._recycle == app.config['DB_POOL_RECYCLE']
+
+    def test_lazy_init(self):
+        lazy = create_app('app.config.Testing')
+        assert lazy.config['LAZY_INIT']
+        assert 'users.read' not in lazy.view_functions
+        with lazy.test_request_context():
+            # the first request context loads the views
+            assert url_for('users.read', id=1) == '/users/1'
+        assert not lazy.deferred
+
+    def test_lazy_init_concurrent_first_requests(self):
+        lazy = create_app('app.config.Testing')
+        init_views = lazy.deferred.pop()
+
+        def slow_init_views(app):
+            time.sleep(0.2)
+            init_views(app)
+        lazy.defer(slow_init_views)
+
+        statuses = []
+
+        def first_request():
+            statuses.append(lazy.test_client().get('/users/').status_code)
+
+        threads = [threading.Thread(target=first_request) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # both wait for the routes, unauthorized rather than not found
+        assert statuses == [401, 401]
+
+    def test_replica_routing(self, app, db, monkeypatch):
+        replica = object()
+
+        class Replicas:
+            def pick(self):
+                return replica
+        monkeypatch.setitem(app.extensions, 'replicas', Replicas())
+        select = User.query.statement
+
+        with app.test_request_context(method='GET'):
+            session = db.create_session({})()
+            assert session.get_bind(User.__mapper__, select) is replica
+            session.get_bind(User.__mapper__, User.__table__.update())
+            # read your writes, the rest of the request stays on the primary
+            assert session.get_bind(User.__mapper__, select) is db.engine
+
+        with app.test_request_context(method='POST'):
+            session = db.create_session({})()
+            assert session.get_bind(User.__mapper__, select) is db.engine
+
+        with app.test_request_context(method='GET'):
+            session = db.create_session({})()
+            with session.primary():
+                assert session.get_bind(User.__mapper__, select) is db.engine
+            # only the block, the rest of the request reads the replica
+            assert session.get_bind(User.__mapper__, select) is replica
+
     def test_api_results(self):
         result = APIResult({'name': 'foo'})
         assert result.status == 200
@@ -27,7 +95,7 @@ class TestApp:
         response = result.to_response()
         assert response.content_type == 'application/json'
         assert response.status_code == 200
-        assert response.data.decode('utf-8') == json.dumps({'name': 'foo'})
+        assert json.loads(response.data.decode('utf-8')) == {'name': 'foo'}
 
         result = APIResult({'name': 'bar'}, status=201, custom_header='lala')
         assert result.status == 201
@@ -37,10 +105,22 @@ class TestApp:
         response = result.to_response()
         assert response.content_type == 'application/json'
         assert response.status_code == 201
-        assert response.data.decode('utf-8') == json.dumps({'name': 'bar'})
+        assert json.loads(response.data.decode('utf-8')) == {'name': 'bar'}
         assert 'custom_header' in response.headers.keys()
         assert 'lala' in result.headers.values()
 
+    def test_api_stream_results(self, app):
+        result = APIStreamResult({'pages': {'page': 1}}, 'users', iter([{'id': 1}, {'id': 2}]))
+        with app.test_request_context():
+            response = result.to_response()
+            assert response.is_streamed
+            assert json.loads(response.get_data(as_text=True)) == {
+                'users': [{'id': 1}, {'id': 2}], 'pages': {'page': 1}}
+
+        result = APIStreamResult({}, 'users', iter([]))
+        with app.test_request_context():
+            assert json.loads(result.to_response().get_data(as_text=True)) == {'users': []}
+
     def test_api_exceptions(self):
         exception = APIException('error')
         assert exception.status == 400
@@ -58,6 +138,15 @@ class TestApp:
         assert result.status == 404
         assert result.value == {'error': 'not found', 'message': 'not found', 'status': 404}
 
+    def test_error_bodies_use_the_app_backend(self, app, monkeypatch):
+        def upper_dumps(value):
+            return json.dumps(value).upper()
+        monkeypatch.setattr(app, 'json_dumps', upper_dumps)
+        resp = self.client.get('/nope')
+        assert resp.status_code == 404
+        assert json.loads(resp.get_data(as_text=True)) == {
+            'STATUS': 404, 'ERROR': 'NOT FOUND', 'MESSAGE': 'INVALID RESOURCE URI'}
+
     def test_flask_make_response(self, app):
         response_text = "Output Text"
 
@@ -77,6 +166,87 @@ class TestApp:
         assert resp.status_code == 200
         assert len(resp.get_json()['users']) == 2
 
+    def test_generations_bump_on_commit(self, db_session):
+        names = ('response:users', 'count:users')
+        before = [generation(_) for _ in names]
+        db_session.add(User(username='gen', email='gen@foo.bar', password='x'))
+        db_session.flush()
+        assert [generation(_) for _ in names] == before
+        db_session.rollback()
+        assert [generation(_) for _ in names] == before
+
+        db_session.add(User(username='gen', email='gen@foo.bar', password='x'))
+        db_session.commit()
+        assert all(a != b for a, b in zip([generation(_) for _ in names], before))
+
+    def test_count_strategies(self, app, monkeypatch, db_session, superuser, user):
+        gone = User(username='gone', email='gone@foo.bar', password='x', active=False)
+        gone.save()
+        assert count_rows(User.query, EXACT) == (2, False)
+        assert count_rows(User.query.with_inactive(), EXACT) == (3, False)
+
+        assert count_rows(User.query, CACHED) == (2, False)
+        # writes bypassing the ORM events are seen once the table is marked changed
+        db_session.execute(
+            User.__table__.update().where(User.id == user.id).values(active=False))
+        assert count_rows(User.query, CACHED) == (2, False)
+        table_changed(User.__tablename__)
+        assert count_rows(User.query, CACHED) == (1, False)
+
+        # small tables are counted exactly
+        db_session.execute('ANALYZE users')
+        assert count_rows(User.query, ESTIMATE) == (1, False)
+        monkeypatch.setitem(app.config, 'COUNT_ESTIMATE_MIN', 0)
+        assert count_rows(User.query.with_inactive(), ESTIMATE) == (3, True)
+        # the active filter is added at compile time, still an estimate of active rows
+        assert count_rows(User.query, ESTIMATE) == (1, True)
+
+    def test_active_queries_use_partial_indexes(self, db_session, user):
+        def plan(query):
+            sql = query.statement.compile(
+                dialect=db_session.get_bind().dialect, compile_kwargs={'literal_binds': True})
+            return '\n'.join(_[0] for _ in db_session.execute('EXPLAIN {}'.format(sql)))
+
+        db_session.add(RevokedToken(user_id=user.id, token='revoked'))
+        db_session.commit()
+        db_session.execute('ANALYZE users')
+        db_session.execute('ANALYZE revoked_tokens')
+        # an index whose predicate the WHERE doesn't imply is never picked
+        db_session.execute('SET LOCAL enable_seqscan = off')
+
+        listing = User.query.order_by(User.created_at, User.id).limit(25)
+        assert 'WHERE users.active ORDER BY' in str(listing.statement)
+        assert 'ix_users_created_at_id_active' in plan(listing)
+
+        # the full indexes qualify as well, without them the partial one must serve
+        db_session.execute(
+            'DROP INDEX ix_revoked_tokens_user_id_token, ix_revoked_tokens_token')
+        probe = db_session.query(RevokedToken.id).filter(
+            RevokedToken.user_id == user.id, RevokedToken.token == 'revoked')
+        assert 'ix_revoked_tokens_user_id_token_active' in plan(probe)
+
+    def test_seed(self, db_session, user):
+        user.active = False
+        user.save()
+        users, tokens = seed(3, tokens=2, seed=7, rounds=4, echo=lambda _: None)
+        assert (users, tokens) == (3, 6)
+
+        seeded = User.query.filter(User.email.like('%@seed.test')).order_by(User.id).all()
+        # ids continue after the soft deleted user
+        assert [_.id for _ in seeded] == [user.id + 1, user.id + 2, user.id + 3]
+        assert seeded[0].verify_password('password')
+        assert len({_.password for _ in seeded}) == 1
+        assert RevokedToken.query.filter(
+            RevokedToken.user_id.in_([_.id for _ in seeded])).count() == 6
+
+        # the sequence follows the generated ids
+        created = User(username='after', email='after@foo.bar', password='x')
+        created.save()
+        assert created.id == user.id + 4
+
+        # same seed same dataset
+        assert seeded_hash(random.Random(7), 'password', 4) == seeded[0].password
+
     def test_command(self, db_session):
         # test testing command :)
         runner = app.test_cli_runner()
@@ -92,8 +262,10 @@ class TestApp:
 
         # check for users both super and anon
         superuser = User.query.first()
-        assert User.query.count() == 2
-        assert User.query.get(-1).username == 'anon'
+        assert User.query.count() == 1
+        assert User.query.with_inactive().count() == 2
+        assert User.query.get(-1) is None
+        assert User.query.with_inactive().get(-1).username == 'anon'
         assert superuser.username == 'flask'
 
         # duplicate superuser
@@ -101,6 +273,31 @@ class TestApp:
             initdb, ['-u', 'flask', '-e', 'flask@boiler.pt', '-p', 'flask'])
         assert result.exit_code == 1
 
+    def test_loadtest_command(self, superuser, db_session, tmpdir):
+        runner = app.test_cli_runner()
+        output = tmpdir.join('results.json')
+        result = runner.invoke(load_test, [
+            '-u', 'super', '-p', 'super', '-m', 'read=2,list,token,create', '-c', '1',
+            '-n', '10', '-o', str(output)])
+        assert result.exit_code == 0
+        assert 'p99' in result.output
+
+        results = json.loads(output.read())
+        assert results['total']['requests'] == 10
+        assert results['total']['errors'] == 0
+        assert results['scenarios']['read']['requests'] == 4
+        # creates authenticate with the token of the load test user
+        assert results['scenarios']['create']['requests'] == 2
+
+    def test_metrics(self, db_session, user, credentials):
+        assert self.client.get(url_for('users.read', id=user.id),
+                               headers=credentials).status_code == 200
+        resp = self.client.get(url_for('metrics'))
+        assert resp.status_code == 200
+        body = resp.get_data(as_text=True)
+        assert 'http_request_duration_seconds_count{endpoint="users.read"' in body
+        assert 'http_requests_in_progress' in body
+
     def test_unhautorized_token_fake_creds(self, user, db_session, fake_credentials):
         resp = self.client.get(
             url_for('users.list'), headers=fake_credentials, content_type='application/json')
@@ -2,7 +2,6 @@ from flask import Blueprint
 
 
 users = Blueprint('users', __name__, url_prefix='/users')
-from app.users import routes    # NOQA
 
 
 @users.before_request
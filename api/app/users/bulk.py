@@ -0,0 +1,363 @@
+import io
+import os
+import csv
+import json
+import time
+import bcrypt as pybcrypt
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from flask import current_app, url_for
+from flask_bouncer import ensure, Unauthorized as Forbidden
+from voluptuous import Invalid
+from sqlalchemy import Boolean
+
+from app.extensions import db, bcrypt
+from app.awaremodel import User, coerce_data
+from app.cache import table_changed
+from app.constants import UPDATE
+from app.factory import APIException
+from app.validators import Exist, deferred_exist_checks, existing_values, was_found
+from app.users.revocation import epochs
+
+
+def hash_passwords(passwords):
+    """bcrypt releases the GIL while hashing, threads hash in parallel"""
+    workers = current_app.config.get('BULK_HASH_WORKERS', 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [_.decode('utf-8') for _ in pool.map(bcrypt.generate_password_hash, passwords)]
+
+
+def error(message, status=409):
+    return {'status': status, 'message': message}
+
+
+def validate_items(schema, items):
+    """
+    Validate every item against the schema, returning per item errors (None when
+    valid). Exist lookups of the whole batch run together and values repeated
+    within the batch are rejected as they would be by the unique constraints.
+    """
+    errors = [None] * len(items)
+    checks = []
+    for index, item in enumerate(items):
+        with deferred_exist_checks() as item_checks:
+            try:
+                schema(item)
+            except Invalid as e:
+                errors[index] = error(
+                    '{} {}'.format('.'.join(map(str, e.path)), e.msg), 400)
+        checks.extend((index, check, value) for check, value in item_checks)
+
+    seen = set()
+    for index, check, value in checks:
+        key = (check.model, check.field, value)
+        if not check.reversed and errors[index] is None and key in seen:
+            errors[index] = error('{} is repeated in the batch'.format(check.field))
+        seen.add(key)
+
+    found = existing_values([(check, value) for _, check, value in checks])
+    for index, check, value in checks:
+        if errors[index] is None:
+            try:
+                check.verify(was_found(found, check, value), path=[check.field])
+            except Invalid as e:
+                errors[index] = error('{} {}'.format('.'.join(map(str, e.path)), e.msg))
+    return errors
+
+
+def batch_items(data):
+    if not isinstance(data, list) or not data:
+        raise APIException('expected a non empty list of users', 400)
+    if len(data) > current_app.config.get('BULK_MAX_ITEMS', 1000):
+        raise APIException('too many users in one batch', 400)
+    if not all(isinstance(_, dict) for _ in data):
+        raise APIException('expected a list of users', 400)
+    return data
+
+
+def with_passwords(rows):
+    """Replace plain passwords by their hashes, hashing the batch in parallel"""
+    indexes = [index for index, row in enumerate(rows) if row.get('password')]
+    hashes = hash_passwords([rows[_]['password'] for _ in indexes])
+    for index, hashed in zip(indexes, hashes):
+        rows[index]['password'] = hashed
+    return rows
+
+
+def complete_rows(table, rows, keys):
+    """Give every row the same keys, missing or null ones get the column's scalar default"""
+    columns = [table.c[key] for key in keys]
+    defaults = {
+        column.key: column.default.arg if getattr(column.default, 'is_scalar', False) else None
+        for column in columns}
+    return [{key: defaults[key] if row.get(key) is None else row[key] for key in keys}
+            for row in rows]
+
+
+def insert_rows(rows):
+    """
+    Insert rows in one multi-row INSERT returning their ids, executemany where
+    the dialect can't return them. Every row gets the same columns, missing
+    ones filled with the column default.
+    """
+    table = User.__table__
+    rows = complete_rows(table, rows, set().union(*rows) - {'id'})
+
+    if db.session.get_bind().dialect.implicit_returning:
+        result = db.session.execute(table.insert().values(rows).returning(table.c.id))
+        return [_.id for _ in result]
+
+    db.session.execute(table.insert(), rows)
+    ids = dict(db.session.query(User.email, User.id).with_inactive().filter(
+        User.email.in_([_['email'] for _ in rows])))
+    return [ids[_['email']] for _ in rows]
+
+
+def create_users(schema, data):
+    """Validate, hash and insert a batch of users in one transaction"""
+    items = batch_items(data)
+    errors = validate_items(schema, items)
+    valid = [index for index, _ in enumerate(errors) if _ is None]
+
+    results = [_ for _ in errors]
+    if valid:
+        rows = with_passwords([coerce_data(User, 'POST', items[_]) for _ in valid])
+        ids = insert_rows(rows)
+        db.session.commit()
+        table_changed(User.__tablename__)
+        for index, id in zip(valid, ids):
+            results[index] = {
+                'status': 201, 'self_url': url_for('users.read', id=id, _external=True)}
+
+    return results, 201 if len(valid) == len(items) else 207
+
+
+def update_users(schema, data):
+    """Validate, authorize and update a batch of users in one transaction"""
+    items = batch_items(data)
+    errors = validate_items(schema, items)
+    # ids of items the schema rejected may be anything, keep them out of the query
+    ids = [item['id'] if errors[index] is None else None for index, item in enumerate(items)]
+    users = {_.id: _ for _ in User.query.filter(User.id.in_([_ for _ in ids if _]))}
+
+    results = [_ for _ in errors]
+    mappings = []
+    for index, item in enumerate(items):
+        if results[index] is not None:
+            continue
+
+        user = users.get(ids[index])
+        if user is None:
+            results[index] = error('user {} not found'.format(ids[index]), 404)
+            continue
+        try:
+            ensure(UPDATE, user)
+        except Forbidden:
+            results[index] = error('forbidden access', 403)
+            continue
+
+        values = coerce_data(User, 'PUT', {k: v for k, v in item.items() if k != 'id'})
+        values['id'] = user.id
+        mappings.append((index, values))
+
+    if mappings:
+        with_passwords([values for _, values in mappings])
+        db.session.bulk_update_mappings(User, [values for _, values in mappings])
+        db.session.commit()
+        table_changed(User.__tablename__)
+        for index, values in mappings:
+            epochs.invalidate(values['id'])
+            results[index] = {'status': 200, 'self_url': users[values['id']].get_url()}
+
+    return results, 200 if len(mappings) == len(items) else 207
+
+
+class MalformedRecord(ValueError):
+    """A source line that doesn't decode, rejected like an invalid record"""
+    def __init__(self, text, reason):
+        ValueError.__init__(self, reason)
+        self.text = text
+
+
+def read_records(path, fmt=None):
+    """Stream the records of a CSV or NDJSON file one at a time with their line number"""
+    fmt = fmt or ('csv' if path.endswith('.csv') else 'ndjson')
+    with open(path, newline='' if fmt == 'csv' else None, encoding='utf-8') as source:
+        if fmt == 'csv':
+            reader = csv.DictReader(source)
+            for record in reader:
+                # an empty CSV field is a missing value, not an empty string
+                yield reader.line_num, {
+                    key: value for key, value in record.items() if value != ''}
+        else:
+            for number, line in enumerate(source, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield number, json.loads(line)
+                except ValueError as e:
+                    reason = 'malformed JSON: {}'.format(e)
+                    yield number, MalformedRecord(line.rstrip('\n'), reason)
+
+
+def hash_password(password, rounds=12):
+    # module level so a process pool can pickle it
+    return pybcrypt.hashpw(password.encode('utf-8'), pybcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def copy_rows(table, keys, rows):
+    """Load rows with COPY FROM STDIN on the session's connection"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    for row in rows:
+        writer.writerow([row[key] for key in keys])
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            table.name, ', '.join(keys)), buffer)
+    finally:
+        cursor.close()
+
+
+class Checkpoint(object):
+    """Records loaded so far from a source, written atomically after each batch"""
+    def __init__(self, path, source):
+        self.path = path
+        self.state = {'source': os.path.abspath(source), 'offset': 0, 'loaded': 0,
+                      'rejected': 0}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get('source') == self.state['source']:
+                self.state = state
+
+    def save(self):
+        if not self.path:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+UNIQUE_CHECKS = (Exist(User, 'username'), Exist(User, 'email'))
+TRUTHY = ('1', 't', 'true', 'y', 'yes')
+
+
+def parse_flags(record):
+    """Read textual booleans from CSV sources, bool('false') would be True"""
+    for column in User.__table__.c:
+        value = record.get(column.key)
+        if isinstance(value, str) and isinstance(column.type, Boolean):
+            record[column.key] = value.strip().lower() in TRUTHY
+    return record
+
+
+def check_lengths(table, row, skip=()):
+    """A value longer than its column would fail the whole COPY, reject the record instead"""
+    for key, value in row.items():
+        length = getattr(table.c[key].type, 'length', None)
+        if key not in skip and length and isinstance(value, str) and len(value) > length:
+            raise ValueError('{} is longer than {} characters'.format(key, length))
+
+
+def prepare_batch(records, rejects, hashed=False):
+    """Coerce records with the column metadata, dropping invalid and duplicate ones"""
+    rows, checks = [], []
+    for number, record in records:
+        try:
+            if isinstance(record, MalformedRecord):
+                raise record
+            if not isinstance(record, dict):
+                raise ValueError('expected an object')
+            row = coerce_data(User, 'POST', parse_flags(dict(record)))
+            row.pop('id', None)
+            if not row.get('email') or not row.get('password'):
+                raise ValueError('email and password are required')
+            # plain passwords are stored hashed, only a given hash must fit
+            check_lengths(User.__table__, row, skip=() if hashed else ('password',))
+        except (ValueError, TypeError) as e:
+            rejects.append((number, getattr(record, 'text', record), str(e)))
+            continue
+        rows.append((number, record, row))
+        checks.extend((check, row[check.field]) for check in UNIQUE_CHECKS
+                      if row.get(check.field) is not None)
+
+    found = existing_values(checks)
+    seen, kept = set(), []
+    for number, record, row in rows:
+        keys = [(check.field, row.get(check.field)) for check in UNIQUE_CHECKS
+                if row.get(check.field) is not None]
+        taken = [field for check, (field, value) in zip(UNIQUE_CHECKS, keys)
+                 if was_found(found, check, value) or (field, value) in seen]
+        if taken:
+            rejects.append((number, record, '{} already exists'.format(', '.join(taken))))
+            continue
+        seen.update(keys)
+        kept.append(row)
+    return kept
+
+
+def import_users(path, fmt=None, batch=10000, workers=None, hashed=False,
+                 checkpoint=None, rejects=None, echo=print):
+    """
+    Load users from a CSV or NDJSON file with COPY in batches of one transaction
+    each, hashing passwords in a process pool. The checkpoint records how far the
+    load got so an interrupted import resumes after the last committed batch.
+    """
+    state = Checkpoint(checkpoint, path)
+    offset = state.state['offset']
+    rounds = current_app.config.get('BCRYPT_LOG_ROUNDS', 12)
+    table = User.__table__
+    started = time.monotonic()
+    loaded = 0
+
+    def batches():
+        chunk = []
+        for number, record in read_records(path, fmt):
+            if number <= offset:
+                continue
+            chunk.append((number, record))
+            if len(chunk) == batch:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for chunk in batches():
+            batch_started = time.monotonic()
+            rejected = []
+            rows = prepare_batch(chunk, rejected, hashed)
+            if rows and not hashed:
+                passwords = pool.map(hash_password, [_['password'] for _ in rows],
+                                     [rounds] * len(rows), chunksize=64)
+                for row, password in zip(rows, passwords):
+                    row['password'] = password
+
+            if rows:
+                # COPY writes NULL into listed columns, leave server defaults to the database
+                given = {key for row in rows for key, value in row.items() if value is not None}
+                keys = sorted(key for key in set().union(*rows)
+                              if key in given or table.c[key].server_default is None)
+                copy_rows(table, keys, complete_rows(table, rows, keys))
+            db.session.commit()
+
+            if rejects is not None:
+                for number, record, reason in rejected:
+                    rejects.write(json.dumps({'line': number, 'reason': reason,
+                                              'record': record}) + '\n')
+
+            loaded += len(rows)
+            state.state['offset'] = chunk[-1][0]
+            state.state['loaded'] += len(rows)
+            state.state['rejected'] += len(rejected)
+            state.save()
+            echo('{} loaded, {} rejected, {:.0f} rows/s'.format(
+                state.state['loaded'], state.state['rejected'],
+                len(chunk) / max(time.monotonic() - batch_started, 1e-9)))
+
+    if loaded:
+        table_changed(User.__tablename__)
+    elapsed = time.monotonic() - started
+    return loaded, elapsed
@@ -12,6 +12,12 @@ class RevokedToken(AwareModel):
     | eyJhbGciOiJub25lIn0.eyJpZCI6FoO0. | bar  |
     |-----------------------------------+------|
     """
+    __table_args__ = (
+        db.Index('ix_revoked_tokens_user_id_token', 'user_id', 'token'),
+        db.Index('ix_revoked_tokens_user_id_token_active', 'user_id', 'token',
+                 postgresql_where=db.text('active')),
+    )
+
     token = db.Column(db.String, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     user = db.relationship(
@@ -21,3 +27,10 @@ class RevokedToken(AwareModel):
     @staticmethod
     def get_revoked(user):
         return RevokedToken.query.filter_by(user_id=user.id).all()
+
+    @staticmethod
+    def is_revoked(user, token):
+        probe = db.session.query(RevokedToken.id).filter(
+            RevokedToken.user_id == user.id,
+            RevokedToken.token == token).exists()
+        return db.session.query(probe).scalar()
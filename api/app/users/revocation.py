@@ -0,0 +1,116 @@
+import json
+from flask import current_app
+from sqlalchemy.event import listens_for
+from sqlalchemy.orm import Session, object_session
+
+from app.extensions import db
+from app.awaremodel import User
+from app.cache import LocalCache, digest, cache_get, cache_set, cache_delete
+from app.users.models import RevokedToken
+
+
+class RevocationStore(object):
+    """
+    Answers whether a token has been revoked with one indexed existence probe.
+
+    Answers are cached per user and revoked_token_count, in process and in redis,
+    so a refresh (which bumps the count) never reads a stale answer.
+    """
+    def __init__(self):
+        self.local = LocalCache()
+
+    @staticmethod
+    def key(user, token):
+        return 'revoked:{}:{}:{}'.format(user.id, user.revoked_token_count, digest(token))
+
+    def is_revoked(self, user, token):
+        key = self.key(user, token)
+        revoked = self.local.get(key)
+        if revoked is not None:
+            return revoked
+
+        ttl = current_app.config.get('REVOKED_TOKEN_CACHE_TTL', 300)
+        cached = cache_get(key)
+        if cached is None:
+            # a lagging replica could cache a revoked token as valid
+            with db.primary():
+                revoked = RevokedToken.is_revoked(user, token)
+            cache_set(key, int(revoked), ttl)
+        else:
+            revoked = cached == b'1'
+
+        self.local.set(key, revoked, ttl)
+        return revoked
+
+    def invalidate(self, user, token):
+        key = self.key(user, token)
+        self.local.delete(key)
+        cache_delete(key)
+
+
+revocations = RevocationStore()
+
+
+class EpochStore(object):
+    """
+    Caches the claims needed to authorize a token without loading the user row.
+
+    The epoch is the user's revoked_token_count: refreshing a token revokes it and
+    bumps the count, so a token is valid only while its count matches the epoch.
+    Entries live briefly in process and longer in redis, invalidation clears both.
+    """
+    def __init__(self):
+        self.local = LocalCache()
+
+    @staticmethod
+    def key(user_id):
+        return 'epoch:{}'.format(user_id)
+
+    def get(self, user_id):
+        key = self.key(user_id)
+        claims = self.local.get(key)
+        if claims is not None:
+            return claims
+
+        cached = cache_get(key)
+        if cached is None:
+            with db.primary():
+                row = db.session.query(User.revoked_token_count, User.force).filter(
+                    User.id == user_id).first()
+            if row is None:
+                return None
+            claims = {'epoch': row.revoked_token_count or 0, 'force': bool(row.force)}
+            ttl = current_app.config.get('TOKEN_EPOCH_CACHE_TTL', 300)
+            cache_set(key, json.dumps(claims), ttl)
+        else:
+            claims = json.loads(cached.decode('utf-8'))
+
+        self.local.set(key, claims, current_app.config.get('TOKEN_EPOCH_LOCAL_TTL', 5))
+        return claims
+
+    def invalidate(self, user_id):
+        key = self.key(user_id)
+        self.local.delete(key)
+        cache_delete(key)
+
+
+epochs = EpochStore()
+
+
+@listens_for(User, 'after_update')
+@listens_for(User, 'after_delete')
+def user_claims_changed(mapper, connection, target):
+    # invalidated at flush, a concurrent request could cache the old claims again
+    # before the commit, keep the ids until then like cache.bump_on_commit
+    object_session(target).info.setdefault('epochs', set()).add(target.id)
+
+
+@listens_for(Session, 'after_commit')
+def invalidate_committed(session):
+    for user_id in session.info.pop('epochs', ()):
+        epochs.invalidate(user_id)
+
+
+@listens_for(Session, 'after_rollback')
+def drop_rolled_back(session):
+    session.info.pop('epochs', None)
@@ -1,15 +1,19 @@
-from flask import request, g
+from flask import request, g, current_app, Response, stream_with_context
 from flask_bouncer import requires, ensure
 
 from app.auth import auth, token
-from app.factory import APIResult
+from app.factory import APIResult, APIException
+from app.exports import FORMATS
 from app.awaremodel import User
-from app.decorators import validate_with, paginate
+from app.decorators import validate_with, paginate, cached, query_budget, use_primary
+from app.counting import ESTIMATE
 from app.constants import CREATE, READ, UPDATE, DELETE, LIST
 
 from app.users import users
 from app.users.models import RevokedToken
-from app.users.schema import create_user, update_user
+from app.users.revocation import revocations, epochs
+from app.users.schema import create_user, update_user, update_users
+from app.users import bulk
 
 
 @users.route('/', methods=['POST'])
@@ -22,13 +26,23 @@ def create():
     return APIResult({'self_url': user.get_url()}, 201, Link=user.get_url())
 
 
+@users.route('/batch', methods=['POST'])
+@token.login_required
+@requires(CREATE, User)
+def create_batch():
+    results, status = bulk.create_users(create_user, request.get_json())
+    return APIResult({'users': results}, status)
+
+
 @users.route('/<int:id>', methods=['GET'])
+@query_budget(3)
 @token.login_required
 @requires(READ, User)
+@cached(User, ttl=60)
 def read(id):
     user = User.query.get_or_404(id)
     ensure(READ, user)
-    return APIResult(user.export_data())
+    return APIResult(user.export_data, etag=user.get_etag(), last_modified=user.modified_at)
 
 
 @users.route('/token')
@@ -39,16 +53,20 @@ def get_token():
 
 
 @users.route('/refresh/token')
+@use_primary
 @auth.login_required
 @requires(UPDATE, User)
 def refresh_token():
     user = g.user
     # revoke the current_token by adding in revoked-tokens
-    revoked_token = RevokedToken(token=user.generate_auth_token(), user_id=user.id)
+    current_token = user.generate_auth_token()
+    revoked_token = RevokedToken(token=current_token, user_id=user.id)
     revoked_token.save()
+    revocations.invalidate(user, current_token)
     # increment the user revoked_count
     user.revoked_token_count += 1
     user.save()
+    epochs.invalidate(user.id)
     # re-generate the new token
     return APIResult({'token': user.generate_auth_token()})
 
@@ -65,6 +83,14 @@ def update(id):
     return APIResult({'self_url': user.get_url()})
 
 
+@users.route('/batch', methods=['PUT'])
+@token.login_required
+@requires(UPDATE, User)
+def update_batch():
+    results, status = bulk.update_users(update_users, request.get_json())
+    return APIResult({'users': results}, status)
+
+
 @users.route('/<int:id>', methods=['DELETE'])
 @token.login_required
 @requires(DELETE, User)
@@ -76,8 +102,25 @@ def delete(id):
 
 
 @users.route('/', methods=['GET'])
+@query_budget(6)
 @token.login_required
 @requires(LIST, User)
-@paginate('users')
+@cached(User, ttl=30)
+@paginate('users', cursor=('created_at', 'modified_at', 'email'), count=ESTIMATE,
+          conditional=True)
 def list():
     return User.query
+
+
+@users.route('/export', methods=['GET'])
+@token.login_required
+@requires(LIST, User)
+def export():
+    fmt = request.args.get('format', 'ndjson', type=str)
+    if fmt not in FORMATS:
+        raise APIException('unknown export format {}'.format(fmt), 400)
+
+    mimetype, lines = FORMATS[fmt]
+    rows = lines(User, User.query, current_app.json_dumps)
+    return Response(stream_with_context(rows), mimetype=mimetype, headers={
+        'Content-Disposition': 'attachment; filename=users.{}'.format(fmt)})
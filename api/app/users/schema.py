@@ -25,6 +25,9 @@ update_user = Schema(
     extra=REMOVE_EXTRA
 )
 
+# a batch update names the user each item applies to
+update_users = update_user.extend({Required('id'): int})
+
 
 forgot_user = Schema(
     {
@@ -1,22 +1,21 @@
-import time
-from datetime import timedelta, date
+import io
+import csv
 import base64
 import pytest
-from flask import url_for, json
-from itsdangerous import URLSafeTimedSerializer
+from flask import url_for, json, g, Response
+from werkzeug.exceptions import HTTPException
 
-from app.extensions import mail
+from app.auth import TokenUser
+from app.commands import export, import_users
+from app.cache import cache_get, table_changed
+from app.extensions import db, redis_store
 from app.awaremodel import User
-from app.profiles.models import Profile
-from app.wallets.models import Wallet
-from app.sms.models import SMS
-from app.telcos.models import Telco
-from app.countries.models import Country
 
 from app.users.models import RevokedToken
-from app.users.routes import confirm, recovery
-
-from app.tasks.send_usage_email import async_send_usage_email, send_usage
+from app.users.revocation import epochs, revocations
+from app.decorators.paginate import paginate_pages
+from app.instrumentation import (
+    QueryBudgetExceeded, NPlusOneDetected, start_request, finish_request)
 
 
 @pytest.mark.usefixtures('client_class')
@@ -25,3 +24,361 @@ class TestUsers:
     def test_users_routes(self, app, monkeypatch, celery_app, db_session,
                           credentials, super_credentials):
         pass
+
+    def test_refresh_token_revokes_current(self, db_session, user, credentials):
+        basic = 'Basic {}'.format(base64.b64encode(b'user:user').decode('utf-8'))
+        resp = self.client.get(url_for('users.read', id=user.id), headers=credentials)
+        assert resp.status_code == 200
+
+        resp = self.client.get(url_for('users.refresh_token'), headers={'Authorization': basic})
+        assert resp.status_code == 200
+        fresh = dict(Authorization='Bearer {}'.format(resp.get_json()['token']))
+        assert RevokedToken.is_revoked(user, credentials['Authorization'].split()[1])
+
+        resp = self.client.get(url_for('users.read', id=user.id), headers=credentials)
+        assert resp.status_code == 401
+
+        resp = self.client.get(url_for('users.read', id=user.id), headers=fresh)
+        assert resp.status_code == 200
+
+    def test_stateless_token_verification(self, app, monkeypatch, db_session, user):
+        # unsigned, as database verification issues them
+        forged = user.generate_auth_token()
+        monkeypatch.setitem(app.config, 'TOKEN_VERIFICATION', 'stateless')
+        credentials = dict(Authorization='Bearer {}'.format(user.generate_auth_token()))
+        resp = self.client.get(url_for('users.read', id=user.id), headers=credentials)
+        assert resp.status_code == 200
+
+        resp = self.client.get(url_for('users.read', id=user.id),
+                               headers=dict(Authorization='Bearer {}'.format(forged)))
+        assert resp.status_code == 401
+
+        user.revoked_token_count += 1
+        user.save()
+        resp = self.client.get(url_for('users.read', id=user.id), headers=credentials)
+        assert resp.status_code == 401
+
+        # claims still cached for a user whose row is gone
+        with app.test_request_context():
+            principal = TokenUser(-42, {'epoch': 0, 'force': False})
+            with pytest.raises(HTTPException) as e:
+                principal.username
+            assert e.value.response.status_code == 401
+
+    def test_epochs_invalidated_on_commit(self, db_session, user):
+        assert epochs.get(user.id)['epoch'] == 0
+        user.revoked_token_count = 1
+        db_session.flush()
+        # not committed yet, the cached claims still hold
+        assert cache_get(epochs.key(user.id)) is not None
+        db_session.rollback()
+        assert epochs.get(user.id)['epoch'] == 0
+
+        user = User.query.get(user.id)
+        user.revoked_token_count = 1
+        db_session.commit()
+        assert cache_get(epochs.key(user.id)) is None
+        assert epochs.get(user.id)['epoch'] == 1
+
+    def test_cached_lookups_read_the_primary(self, app, monkeypatch, db_session, user):
+        class Replicas:
+            def pick(self):
+                raise AssertionError('a cached lookup read a replica')
+        monkeypatch.setitem(app.extensions, 'replicas', Replicas())
+        epochs.invalidate(user.id)
+        revocations.invalidate(user, 'token')
+
+        with app.test_request_context(method='GET'):
+            db.session().reset_routing()
+            assert epochs.get(user.id)['epoch'] == user.revoked_token_count
+            assert not revocations.is_revoked(user, 'token')
+
+    def test_list_cursor_pagination(self, db_session, user, super_credentials):
+        resp = self.client.get(
+            url_for('users.list', cursor='', per_page=1, total=1), headers=super_credentials)
+        assert resp.status_code == 200
+        first = resp.get_json()
+        assert len(first['users']) == 1
+        assert first['pages']['total'] == 2
+        assert first['pages']['prev_url'] is None
+
+        resp = self.client.get(first['pages']['next_url'], headers=super_credentials)
+        second = resp.get_json()
+        assert len(second['users']) == 1
+        assert second['users'] != first['users']
+        assert second['pages']['next_url'] is None
+
+        resp = self.client.get(second['pages']['prev_url'], headers=super_credentials)
+        assert resp.get_json()['users'] == first['users']
+
+        resp = self.client.get(url_for('users.list', cursor='bogus'), headers=super_credentials)
+        assert resp.status_code == 400
+
+        resp = self.client.get(url_for('users.list', cursor='', order_by='email', per_page=1),
+                               headers=super_credentials)
+        assert resp.status_code == 200
+        by_email = resp.get_json()['users']
+        resp = self.client.get(resp.get_json()['pages']['next_url'], headers=super_credentials)
+        by_email += resp.get_json()['users']
+        assert sorted(by_email) == sorted(first['users'] + second['users'])
+
+        # tampered cursors whose values do not fit the cursor column
+        for order, position in (('email', {'v': 5, 'id': 1, 'd': 'next'}),
+                                ('created_at', {'v': 'yesterday', 'id': 1, 'd': 'next'}),
+                                ('created_at', {'v': 5, 'id': 1, 'd': 'next'}),
+                                ('email', {'v': 'a@foo.bar', 'id': '1', 'd': 'next'})):
+            cursor = base64.urlsafe_b64encode(json.dumps(position).encode('utf-8'))
+            resp = self.client.get(url_for('users.list', cursor=cursor.decode('utf-8'),
+                                           order_by=order), headers=super_credentials)
+            assert resp.status_code == 400
+
+        # hidden, nullable or undeclared columns are refused rather than leaked
+        for order in ('password', 'username', 'last_login_at', 'nope'):
+            resp = self.client.get(url_for('users.list', cursor='', order_by=order),
+                                   headers=super_credentials)
+            assert resp.status_code == 400
+
+    @pytest.mark.parametrize('mode', ['query', 'batch', 'constraint'])
+    def test_create_user_conflicts(self, app, monkeypatch, mode, db_session, user,
+                                   super_credentials):
+        monkeypatch.setitem(app.config, 'UNIQUE_VALIDATION', mode)
+        payload = {'username': 'user', 'email': 'new@foo.bar', 'password': 'secret'}
+        resp = self.client.post(url_for('users.create'), data=json.dumps(payload),
+                                headers=super_credentials, content_type='application/json')
+        assert resp.status_code == 409
+        assert resp.get_json()['message'] == 'username already exists in the database'
+
+        payload = {'username': 'new', 'email': 'user@foo.bar', 'password': 'secret'}
+        resp = self.client.post(url_for('users.create'), data=json.dumps(payload),
+                                headers=super_credentials, content_type='application/json')
+        assert resp.status_code == 409
+        assert resp.get_json()['message'] == 'email already exists in the database'
+
+    def test_query_budget(self, app, monkeypatch, db_session, user, super_credentials):
+        monkeypatch.setitem(app.config, 'SERVER_TIMING', True)
+        resp = self.client.get(url_for('users.read', id=user.id), headers=super_credentials)
+        assert resp.status_code == 200
+        assert resp.headers['Server-Timing'].startswith('db;dur=')
+
+        # the queries of a streamed export run after the budget is checked
+        monkeypatch.setitem(app.config, 'QUERY_BUDGET_STRICT', True)
+        monkeypatch.setitem(app.config, 'QUERY_BUDGETS', {'users.create_batch': 1})
+        payload = [{'username': 'first', 'email': 'first@foo.bar', 'password': 'secret'}]
+        with pytest.raises(QueryBudgetExceeded):
+            self.client.post(url_for('users.create_batch'), data=json.dumps(payload),
+                             headers=super_credentials, content_type='application/json')
+
+    def test_request_state_does_not_leak(self, app, monkeypatch, db_session, user,
+                                         credentials):
+        monkeypatch.setitem(app.config, 'QUERY_BUDGET_STRICT', True)
+        resp = self.client.get(url_for('users.read', id=user.id), headers=credentials)
+        assert resp.status_code == 200
+        # refresh has no budget of its own, read's 3 must not carry over
+        basic = 'Basic {}'.format(base64.b64encode(b'user:user').decode('utf-8'))
+        resp = self.client.get(url_for('users.refresh_token'), headers={'Authorization': basic})
+        assert resp.status_code == 200
+
+        g.use_primary = True
+        db.reset_routing()
+        assert 'use_primary' not in g
+
+    def test_n_plus_one_detection(self, app, monkeypatch, db_session):
+        monkeypatch.setitem(app.config, 'QUERY_BUDGET_STRICT', True)
+        for index in range(5):
+            User(username='user{}'.format(index), email='user{}@foo.bar'.format(index),
+                 password='x').save()
+
+        with app.test_request_context(url_for('users.list')):
+            start_request()
+            db.session.expire_all()
+            items, _ = paginate_pages(User.query, 'created_at', 25, None, eager=('revoked',))
+            assert [_.revoked for _ in items] == [None] * 5
+            assert g.sql.count == 2
+            finish_request(Response())
+
+            start_request()
+            db.session.expire_all()
+            items, _ = paginate_pages(User.query, 'created_at', 25, None)
+            assert [_.revoked for _ in items] == [None] * 5
+            with pytest.raises(NPlusOneDetected):
+                finish_request(Response())
+
+    def test_list_rejects_empty_pages(self, db_session, user, super_credentials):
+        for args in ({'per_page': -5}, {'per_page': 0}, {'per_page': -5, 'cursor': ''},
+                     {'page': 0}):
+            resp = self.client.get(url_for('users.list', **args), headers=super_credentials)
+            assert resp.status_code == 404
+
+    def test_conditional_get(self, db_session, user, super_credentials):
+        resp = self.client.get(url_for('users.read', id=user.id), headers=super_credentials)
+        assert resp.status_code == 200
+        etag = resp.headers['ETag']
+        assert etag.startswith('W/')
+
+        headers = dict(super_credentials, **{'If-None-Match': etag})
+        resp = self.client.get(url_for('users.read', id=user.id), headers=headers)
+        assert resp.status_code == 304
+        assert resp.data == b''
+
+        extra = User(username='extra', email='extra@foo.bar', password='x')
+        extra.save()
+        resp = self.client.get(url_for('users.list'), headers=super_credentials)
+        assert 'Last-Modified' not in resp.headers
+        headers = dict(super_credentials, **{'If-None-Match': resp.headers['ETag']})
+        assert self.client.get(url_for('users.list'), headers=headers).status_code == 304
+
+        # a hard delete leaves max(modified_at) as it was but not the page
+        extra.remove(soft=False)
+        resp = self.client.get(url_for('users.list'), headers=headers)
+        assert resp.status_code == 200
+        assert len(resp.get_json()['users']) == 2
+
+    def test_response_cache_releases_its_lock(self, app, monkeypatch, db_session, user,
+                                              super_credentials):
+        etag = self.client.get(url_for('users.read', id=user.id),
+                               headers=super_credentials).headers['ETag']
+        monkeypatch.setitem(app.config, 'RESPONSE_CACHE', True)
+        # a generation no earlier run filled
+        table_changed(User.__tablename__)
+
+        def locks():
+            return list(redis_store.scan_iter('response:users.read:*:lock'))
+
+        headers = dict(super_credentials, **{'If-None-Match': etag})
+        for _ in range(2):
+            resp = self.client.get(url_for('users.read', id=user.id), headers=headers)
+            assert resp.status_code == 304
+            assert locks() == []
+        resp = self.client.get(url_for('users.read', id=-42), headers=super_credentials)
+        assert resp.status_code == 404
+        assert locks() == []
+
+    def test_create_users_batch(self, db_session, user, super_credentials):
+        payload = [
+            {'username': 'first', 'email': 'first@foo.bar', 'password': 'secret'},
+            {'username': 'user', 'email': 'taken@foo.bar', 'password': 'secret'},
+            {'username': 'first', 'email': 'again@foo.bar', 'password': 'secret'},
+        ]
+        resp = self.client.post(url_for('users.create_batch'), data=json.dumps(payload),
+                                headers=super_credentials, content_type='application/json')
+        assert resp.status_code == 207
+        results = resp.get_json()['users']
+        assert results[0]['status'] == 201
+        assert results[1]['message'] == 'username already exists in the database'
+        assert results[2]['message'] == 'username is repeated in the batch'
+        assert User.query.filter_by(username='first').first().verify_password('secret')
+
+    def test_update_users_batch(self, db_session, user, superuser, credentials,
+                                super_credentials):
+        payload = [{'id': user.id, 'email': 'moved@foo.bar', 'password': 'changed'},
+                   {'id': -42, 'email': 'nobody@foo.bar'},
+                   {'email': 'noid@foo.bar'}, {'id': 'x'}, {'id': [user.id]}]
+        resp = self.client.put(url_for('users.update_batch'), data=json.dumps(payload),
+                               headers=super_credentials, content_type='application/json')
+        assert resp.status_code == 207
+        results = resp.get_json()['users']
+        assert [_['status'] for _ in results] == [200, 404, 400, 400, 400]
+        assert results[2]['message'] == 'id required key not provided'
+        updated = User.query.get(user.id)
+        assert updated.email == 'moved@foo.bar'
+        assert updated.verify_password('changed')
+
+        payload = [{'id': superuser.id, 'email': 'hijack@foo.bar'}]
+        resp = self.client.put(url_for('users.update_batch'), data=json.dumps(payload),
+                               headers=credentials, content_type='application/json')
+        assert resp.get_json()['users'][0]['status'] == 403
+        assert User.query.get(superuser.id).email == 'super@foo.bar'
+
+    def test_export(self, app, db_session, user, super_credentials, tmpdir):
+        gone = User(username='gone', email='gone@foo.bar', password='x', active=False)
+        gone.save()
+        # the fixture client preserves request contexts, streamed ones push theirs twice
+        client = app.test_client()
+
+        resp = client.get(url_for('users.export'), headers=super_credentials)
+        assert resp.status_code == 200
+        assert resp.mimetype == 'application/x-ndjson'
+        rows = [json.loads(_) for _ in resp.get_data(as_text=True).splitlines()]
+        assert [_['username'] for _ in rows] == ['user', 'super']
+        assert 'password' not in rows[0]
+
+        resp = client.get(url_for('users.export', format='csv'), headers=super_credentials)
+        assert resp.mimetype == 'text/csv'
+        assert resp.headers['Content-Disposition'] == 'attachment; filename=users.csv'
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        assert [_['email'] for _ in rows] == ['user@foo.bar', 'super@foo.bar']
+
+        # one JSON document, still written a row at a time
+        resp = client.get(url_for('users.export', format='json'), headers=super_credentials)
+        assert resp.is_streamed
+        assert resp.mimetype == 'application/json'
+        assert [_['username'] for _ in resp.get_json()['users']] == ['user', 'super']
+
+        resp = client.get(url_for('users.export', format='xml'), headers=super_credentials)
+        assert resp.status_code == 400
+
+        runner = app.test_cli_runner()
+        output = tmpdir.join('users.ndjson')
+        result = runner.invoke(export, ['users', '-o', str(output), '--batch', '1'])
+        assert result.exit_code == 0
+        assert [json.loads(_)['username'] for _ in output.readlines()] == ['user', 'super']
+
+        result = runner.invoke(export, ['users', '-f', 'json', '-o', str(output)])
+        assert result.exit_code == 0
+        assert [_['username'] for _ in json.loads(output.read())['users']] == ['user', 'super']
+
+        result = runner.invoke(export, ['users', '-f', 'csv', '-o', str(output), '--inactive'])
+        assert result.exit_code == 0
+        assert [_['username'] for _ in csv.DictReader(output.open())] == [
+            'user', 'super', 'gone']
+
+    def test_import_users(self, app, db_session, user, tmpdir):
+        source = tmpdir.join('users.csv')
+        source.write('username,email,password,active\n'
+                     'first,first@foo.bar,secret,true\n'
+                     'taken,user@foo.bar,secret,true\n'
+                     'nopass,nopass@foo.bar,,true\n'
+                     'first,again@foo.bar,secret,true\n'
+                     'idle,idle@foo.bar,secret,false\n')
+        checkpoint, rejects = tmpdir.join('checkpoint.json'), tmpdir.join('rejects.ndjson')
+        options = ['--batch', '2', '--workers', '1', '--checkpoint', str(checkpoint),
+                   '--rejects', str(rejects)]
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(import_users, [str(source)] + options)
+        assert result.exit_code == 0
+        assert 'Imported 2 users' in result.output
+        assert User.query.filter_by(username='first').first().verify_password('secret')
+        # textual booleans are parsed, 'false' is not truthy
+        assert User.query.with_inactive().filter_by(username='idle').first().active is False
+        assert [(_['line'], _['reason']) for _ in map(json.loads, rejects.readlines())] == [
+            (3, 'email already exists'), (4, 'email and password are required'),
+            (5, 'username already exists')]
+        # offsets are source lines, the header included
+        assert json.loads(checkpoint.read())['offset'] == 6
+
+        # a rerun resumes after the last committed batch
+        source.write('later,later@foo.bar,secret,true\n', mode='a')
+        result = runner.invoke(import_users, [str(source)] + options)
+        assert result.exit_code == 0
+        assert 'Imported 1 users' in result.output
+        assert User.query.with_inactive().filter(User.email.like('%@foo.bar')).count() == 4
+        assert json.loads(checkpoint.read()) == {
+            'source': str(source), 'offset': 7, 'loaded': 3, 'rejected': 3}
+
+        # one bad record is rejected on its own, the rest of its batch loads
+        source = tmpdir.join('users.ndjson')
+        too_long = json.dumps({'username': 'x' * 128, 'email': 'long@foo.bar',
+                               'password': 'secret'})
+        source.write('\n'.join([
+            '{"username": "json", "email": "json@foo.bar", "password": "secret"}',
+            '{"username": "broken", ', '', '["not", "an", "object"]', too_long]) + '\n')
+        result = runner.invoke(import_users, [str(source), '--rejects', str(rejects)])
+        assert result.exit_code == 0
+        assert 'Imported 1 users' in result.output
+        rejected = [json.loads(_) for _ in rejects.readlines()]
+        assert [_['line'] for _ in rejected] == [2, 4, 5]
+        assert rejected[0]['record'] == '{"username": "broken", '
+        assert rejected[0]['reason'].startswith('malformed JSON')
+        assert rejected[1]['reason'] == 'expected an object'
+        assert rejected[2]['reason'] == 'username is longer than 127 characters'
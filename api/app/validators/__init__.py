@@ -1 +1,3 @@
-from app.validators.exists import Exist, DoesntExist    # NOQA
+from app.validators.exists import (    # NOQA
+    Exist, DoesntExist, deferred_exist_checks, existing_values, was_found,
+    verify_exist_checks)
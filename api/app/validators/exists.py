@@ -1,5 +1,11 @@
+from contextlib import contextmanager
+from collections import OrderedDict
+from flask import g
+from sqlalchemy import or_
 from voluptuous import Invalid
 
+from app.extensions import db
+
 
 class Exist:
     """Verifies against the database an entity exist or not in the database"""
@@ -10,14 +16,23 @@ class Exist:
         self.msg = msg
 
     def __call__(self, v):
+        # inside deferred_exist_checks the lookup is batched with the others
+        checks = g.get('exist_checks')
+        if checks is not None:
+            checks.append((self, v))
+            return v
+
         filters = {self.field: v}
-        query = self.model.query.filter_by(**filters).first()
-        if query is not None and self.reversed is False:
-            raise Invalid(self.msg or "already exists in the database")
-        if query is None and self.reversed is True:
-            raise Invalid(self.msg or "doesn't exists in the database")
+        query = self.model.query if self.reversed else self.model.query.with_inactive()
+        self.verify(query.filter_by(**filters).first() is not None)
         return v
 
+    def verify(self, exists, path=None):
+        if exists and self.reversed is False:
+            raise Invalid(self.msg or "already exists in the database", path=path)
+        if not exists and self.reversed is True:
+            raise Invalid(self.msg or "doesn't exists in the database", path=path)
+
 
 class DoesntExist(Exist):
     """Verifies against the database an entity doesn't exist in the database"""
@@ -25,4 +40,48 @@ class DoesntExist(Exist):
         Exist.__init__(self, model, field, reversed=reversed, msg=msg)
 
     def __call__(self, v):
-        Exist.__call__(self, v=v)
+        return Exist.__call__(self, v=v)
+
+
+@contextmanager
+def deferred_exist_checks():
+    """Collect the Exist checks run by a schema instead of querying one by one"""
+    checks = g.exist_checks = []
+    try:
+        yield checks
+    finally:
+        g.exist_checks = None
+
+
+def existing_values(checks):
+    """
+    Look up collected checks with one SELECT per model and direction, an IN list
+    per field OR'ed together. Returns the (model, reversed, field, value) found.
+    """
+    groups = OrderedDict()
+    for check, value in checks:
+        fields = groups.setdefault((check.model, check.reversed), OrderedDict())
+        fields.setdefault(check.field, set()).add(value)
+
+    found = set()
+    for (model, reversed), fields in groups.items():
+        query = db.session.query(*[getattr(model, _) for _ in fields])
+        if not reversed:
+            query = query.with_inactive()
+        rows = query.filter(or_(*[
+            getattr(model, field).in_(values) for field, values in fields.items()])).all()
+        found.update(
+            (model, reversed, field, getattr(row, field)) for row in rows for field in fields)
+    return found
+
+
+def was_found(found, check, value):
+    return (check.model, check.reversed, check.field, value) in found
+
+
+def verify_exist_checks(checks, unique=True):
+    """Verify collected checks in batch, unique=False leaves uniqueness to the database"""
+    checks = [(check, value) for check, value in checks if unique or check.reversed]
+    found = existing_values(checks)
+    for check, value in checks:
+        check.verify(was_found(found, check, value), path=[check.field])
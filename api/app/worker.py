@@ -1,7 +1,19 @@
 #!/usr/bin/env python
+from celery import Celery
+from celery.signals import worker_process_init
+
+from app.config import Base
 from app.factory import create_app
-from app.extensions import celery    # NOQA
+from app.extensions import reset_connections
 
 
+celery = Celery(__name__, broker=Base.CELERY_BROKER_URL)
 app = create_app()
+celery.conf.update(app.config)
 app.app_context().push()
+
+
+@worker_process_init.connect
+def reset_connections_after_fork(**kwargs):
+    # prefork children must not share the parent's database and redis connections
+    reset_connections(app)
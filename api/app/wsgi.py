@@ -0,0 +1,11 @@
+"""
+Production WSGI application, served by gunicorn
+
+    gunicorn -c gunicorn.conf.py app.wsgi:app
+"""
+from app.factory import create_app
+
+
+app = create_app('app.config.Production')
+# views are loaded in the preloading master once, not by each worker's first request
+app.load_deferred()
@@ -0,0 +1,9 @@
+"""
+Micro-benchmarks for the request hot paths, run from the api directory e.g.
+
+    python -m benchmarks.bench_export
+
+The whole suite, compared against a stored baseline, runs with
+
+    python -m benchmarks
+"""
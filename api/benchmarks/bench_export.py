@@ -0,0 +1,95 @@
+"""
+Per row cost of export_data, the compiled plan against the original per call
+type dispatch it replaced
+"""
+import timeit
+from datetime import datetime
+from flask import url_for
+from sqlalchemy.sql import sqltypes
+
+from app.factory import create_app
+from app.awaremodel import User, get_columns, get_relationships
+
+
+def legacy_export_data(obj, **kwargs):
+    data = dict()
+    columns = get_columns(obj)
+    relationships = get_relationships(obj)
+    date_type = (sqltypes.DateTime, sqltypes.Date, sqltypes.Time, sqltypes.TIMESTAMP)
+    int_type = (sqltypes.BigInteger, sqltypes.SmallInteger, sqltypes.Integer)
+    dec_type = (sqltypes.REAL, sqltypes.DECIMAL, sqltypes.Numeric, sqltypes.Float)
+
+    data['self_url'] = obj.get_url(**kwargs)
+
+    for key in columns.keys():
+        if key in obj.IGNORE_FIELDS:
+            continue
+
+        col_value = getattr(obj, key)
+        if col_value is None:
+            data[key] = None
+            continue
+
+        if isinstance(columns.get(key).type, date_type):
+            data[key] = col_value.isoformat()
+            continue
+
+        if isinstance(columns.get(key).type, sqltypes.Boolean):
+            data[key] = str(col_value).lower()
+            continue
+
+        if isinstance(columns.get(key).type, int_type):
+            data[key] = int(col_value)
+            continue
+
+        if isinstance(columns.get(key).type, dec_type):
+            data[key] = float(col_value)
+            continue
+
+        data[key] = str(col_value)
+
+    for key in relationships.keys():
+        req = kwargs.get('request', None)
+        if req:
+            endpoint = '{}.list_{}'.format(req.endpoint.split('.')[0], key)
+        else:
+            endpoint = '{}.list_{}'.format(obj.__tablename__, key)
+        try:
+            data['{}_url'.format(key)] = url_for(endpoint, id=obj.id, _external=True)
+        except Exception:
+            pass
+
+    return data
+
+
+def make_users(count):
+    now = datetime.utcnow()
+    return [
+        User(id=i, username='user{}'.format(i), email='user{}@boiler.pt'.format(i),
+             password='x', active=True, force=False, confirmed_at=now, created_at=now,
+             modified_at=now, last_login_ip='127.0.0.1', revoked_token_count=i % 7,
+             login_count=i)
+        for i in range(1, count + 1)]
+
+
+def per_row(fn, rows, repeat=5):
+    timer = timeit.Timer(lambda: [fn(_) for _ in rows])
+    return min(timer.repeat(repeat=repeat, number=1)) / len(rows)
+
+
+def main(count=2000):
+    app = create_app('app.config.Testing')
+    app.config['SERVER_NAME'] = 'localhost'
+    with app.test_request_context():
+        rows = make_users(count)
+        assert legacy_export_data(rows[0]) == rows[0].export_data()
+
+        before = per_row(legacy_export_data, rows)
+        after = per_row(lambda _: _.export_data(), rows)
+
+    print('export_data per row: before {:.2f}us after {:.2f}us ({:.1f}x)'.format(
+        before * 1e6, after * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    main()
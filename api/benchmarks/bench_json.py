@@ -0,0 +1,38 @@
+"""
+Encoding cost of a realistic expanded users list page for every installed
+JSON backend
+"""
+import timeit
+import json as stdlib_json
+
+from app.factory import create_app
+from app.encoders import backends
+from benchmarks.bench_export import make_users
+
+
+def users_page(count=25):
+    rows = make_users(count)
+    users = [_.export_data() for _ in rows]
+    pages = {'page': 1, 'per_page': count, 'total': 10000, 'pages': 10000 // count,
+             'estimated': False, 'prev_url': None,
+             'next_url': 'http://localhost/users/?page=2&per_page={}'.format(count),
+             'first_url': 'http://localhost/users/?page=1&per_page={}'.format(count),
+             'last_url': 'http://localhost/users/?page=400&per_page={}'.format(count)}
+    return {'users': users, 'pages': pages}
+
+
+def main(number=2000):
+    app = create_app('app.config.Testing')
+    app.config['SERVER_NAME'] = 'localhost'
+    with app.test_request_context():
+        payload = users_page()
+        encoders = dict(backends, stdlib=stdlib_json.dumps)
+        for name, dumps in sorted(encoders.items()):
+            assert stdlib_json.loads(dumps(payload)) == payload
+            timer = timeit.Timer(lambda: dumps(payload))
+            best = min(timer.repeat(repeat=5, number=number)) / number
+            print('{:<10} {:8.1f}us per users page'.format(name, best * 1e6))
+
+
+if __name__ == '__main__':
+    main()
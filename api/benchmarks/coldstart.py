@@ -0,0 +1,121 @@
+"""
+Cold start, wall time of fresh interpreters importing the application, building
+it, serving a first request or running CLI commands. Each scenario runs once to
+warm the bytecode and page caches, then the best and median of the timed runs
+are reported and compared to a JSON baseline like the hot path suite.
+
+    python -m benchmarks.coldstart                  # compare against the baseline
+    python -m benchmarks.coldstart --save           # record a new baseline
+    python -m benchmarks.coldstart --profile create_app
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import statistics
+import subprocess
+from collections import OrderedDict
+
+from benchmarks.suite import BASELINES, compare
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUILD = "from app.factory import create_app; app = create_app('app.config.Production')"
+
+SCENARIOS = OrderedDict([
+    ('import app', ['-c', 'import app']),
+    ('create_app', ['-c', BUILD]),
+    ('first request', ['-c', BUILD + "; app.test_client().get('/users/')"]),
+    ('wsgi', ['-c', 'import app.wsgi']),
+    ('celery worker', ['-c', 'import app.worker']),
+    ('flask --help', ['-m', 'flask', '--help']),
+    ('flask test --help', ['-m', 'flask', 'test', '--help']),
+])
+
+
+def environ():
+    env = dict(os.environ, FLASK_APP='app', FLASK_MODE='app.config.Production')
+    env.pop('prometheus_multiproc_dir', None)
+    return env
+
+
+def spawn(args, options=()):
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable] + list(options) + args, cwd=ROOT, env=environ(),
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - started
+    if process.returncode:
+        raise RuntimeError('{} failed:\n{}'.format(' '.join(args), process.stderr.decode()))
+    return elapsed, process.stderr.decode()
+
+
+def measure(args, repeat):
+    spawn(args)
+    times = [spawn(args)[0] for _ in range(repeat)]
+    return min(times), statistics.median(times)
+
+
+def profile(args, top=25):
+    """Modules by cumulative import time, from python -X importtime"""
+    _, stderr = spawn(args, ['-X', 'importtime'])
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), int(own), name.strip()))
+    rows.sort(reverse=True)
+    lines = ['{:>10} {:>10}  {}'.format('cumul. ms', 'self ms', 'module')]
+    for cumulative, own, name in rows[:top]:
+        lines.append('{:10.1f} {:10.1f}  {}'.format(cumulative / 1000, own / 1000, name))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.coldstart', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='selected', action='append',
+                        help="Run only scenarios whose name contains this")
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per scenario")
+    parser.add_argument('--profile', metavar='SCENARIO', choices=list(SCENARIOS),
+                        help="Print the import time profile of one scenario instead")
+    parser.add_argument('--baseline', help="Baseline file")
+    parser.add_argument('--save', action='store_true', help="Write results as the baseline")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Slowdown flagged as a regression, 0.2 is 20%%")
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        print(profile(SCENARIOS[args.profile]))
+        return 0
+
+    results = OrderedDict()
+    for name, command in SCENARIOS.items():
+        if args.selected and not any(_ in name for _ in args.selected):
+            continue
+        best, median = measure(command, args.repeat)
+        results[name] = best
+        print('{:<24} {:8.1f}ms best {:8.1f}ms median'.format(name, best * 1e3, median * 1e3))
+
+    path = args.baseline or os.path.join(BASELINES, 'coldstart.json')
+    if args.save:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'python': platform.python_version(), 'results': results}, f, indent=2)
+        print('baseline written to {}'.format(path))
+        return 0
+
+    if not os.path.exists(path):
+        print('no baseline at {}, record one with --save'.format(path))
+        return 1
+
+    with open(path) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline['results'], args.threshold)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,223 @@
+"""
+Hot path benchmarks, in isolation and end to end through the test client,
+against PostgreSQL or an in-memory SQLite stand-in. Results are compared to a
+JSON baseline and anything slower than the threshold is flagged.
+
+    python -m benchmarks                       # compare against the baseline
+    python -m benchmarks --save                # record a new baseline
+    BENCH_DATABASE_URI=postgresql://... python -m benchmarks -k paginate
+"""
+import os
+import sys
+import json
+import timeit
+import platform
+import argparse
+from collections import OrderedDict
+from flask import g, current_app
+
+from app.factory import create_app, APIResult
+from app.extensions import db
+from app.awaremodel import User
+from app.users.models import RevokedToken
+from app.users.revocation import revocations, epochs
+from app.seed import seed, insert
+
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines')
+PAGE_DEPTHS = (1, 10, 100)
+REVOKED_COUNTS = (0, 10, 1000)
+
+cases = OrderedDict()
+
+
+def case(name, number=100, repeat=7):
+    """Register a setup function returning the callable to time, or a dict of them"""
+    def decorator(f):
+        cases[name] = (f, number, repeat)
+        return f
+    return decorator
+
+
+def measure(fn, number, repeat):
+    """Best seconds per call over repeat runs of number calls"""
+    rv = fn()
+    status = getattr(rv, 'status_code', 200)
+    assert status < 400, 'benchmarked request answered {}'.format(status)
+    return min(timeit.Timer(fn).repeat(repeat=repeat, number=number)) / number
+
+
+def bench_app(database=None, redis=None):
+    app = create_app('app.config.Testing')
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI=database or os.environ.get('BENCH_DATABASE_URI', 'sqlite://'),
+        REDIS_URI=redis or os.environ.get('BENCH_REDIS_URI'),
+        SERVER_NAME='localhost')
+    # extensions read the configuration when they are initialised
+    from app.extensions import redis_store
+    redis_store.init_app(app)
+    return app
+
+
+def populate(users):
+    """Deterministic dataset, the first user is a superuser and a few carry revoked tokens"""
+    if db.engine.dialect.name == 'sqlite':
+        # non native booleans emit unnamed CHECKs, name them after their column here only
+        db.metadata.naming_convention = dict(
+            db.metadata.naming_convention, ck='ck_%(table_name)s_%(column_0_name)s')
+    db.drop_all()
+    db.create_all()
+    seed(users, seed=0, password='password', echo=lambda *args: None,
+         rounds=current_app.config.get('BCRYPT_LOG_ROUNDS', 12))
+    User.query.filter_by(id=1).update({'force': True})
+
+    for index, count in enumerate(REVOKED_COUNTS, 2):
+        insert(RevokedToken, [{'user_id': index, 'token': 'revoked{}'.format(_), 'active': True}
+                              for _ in range(count)] or [{'user_id': 1, 'token': 'x'}])
+        User.query.filter_by(id=index).update({'revoked_token_count': count})
+    db.session.commit()
+
+
+def bearer(user):
+    return {'Authorization': 'Bearer {}'.format(user.generate_auth_token())}
+
+
+@case('export_data', number=20)
+def export_data(app):
+    users = User.query.order_by(User.id).limit(100).all()
+    return lambda: [_.export_data() for _ in users]
+
+
+@case('import_data', number=20)
+def import_data(app):
+    data = {'username': 'someone', 'email': 'someone@seed.test', 'active': 'true',
+            'confirmed_at': '2019-01-01', 'login_count': '3'}
+    users = [User() for _ in range(100)]
+    return lambda: [_.import_data('PUT', data) for _ in users]
+
+
+@case('to_response')
+def to_response(app):
+    users = [_.export_data() for _ in User.query.order_by(User.id).limit(25)]
+    payload = {'users': users, 'pages': {'page': 1, 'per_page': 25}}
+    return lambda: APIResult(payload).to_response()
+
+
+@case('verify_password', number=1, repeat=3)
+def verify_password(app):
+    user = User.query.get(1)
+    return lambda: user.verify_password('password')
+
+
+@case('verify_token')
+def verify_token(app):
+    from app.auth import verify_token
+
+    def uncached(token):
+        def run():
+            # the lookups are cached per process, time the database probe
+            revocations.local.clear()
+            epochs.local.clear()
+            return verify_token(token)
+        return run
+
+    return {'revoked={}'.format(count): uncached(User.query.get(index).generate_auth_token())
+            for index, count in enumerate(REVOKED_COUNTS, 2)}
+
+
+@case('GET /users/<id>')
+def read_user(app):
+    client = app.test_client()
+    headers = bearer(User.query.get(1))
+    return lambda: client.get('/users/2', headers=headers)
+
+
+@case('GET /users/?page', number=20)
+def list_users(app):
+    client = app.test_client()
+    headers = bearer(User.query.get(1))
+    pages = User.query.count() // 25
+    return {'page={}'.format(page): (
+        lambda page=page: client.get('/users/?expanded=1&per_page=25&page={}'.format(page),
+                                     headers=headers)) for page in PAGE_DEPTHS if page <= pages}
+
+
+@case('GET /users/?cursor', number=20)
+def cursor_users(app):
+    client = app.test_client()
+    headers = bearer(User.query.get(1))
+    return lambda: client.get('/users/?expanded=1&per_page=25&cursor=', headers=headers)
+
+
+def run(app, selected=None):
+    results = OrderedDict()
+    with app.test_request_context():
+        g.user = User.query.get(1)
+        for name, (setup, number, repeat) in cases.items():
+            if selected and not any(_ in name for _ in selected):
+                continue
+            fns = setup(app)
+            fns = fns if isinstance(fns, dict) else {None: fns}
+            for variant, fn in fns.items():
+                key = '{}[{}]'.format(name, variant) if variant else name
+                results[key] = measure(fn, number, repeat)
+                print('{:<36} {:12.1f}us'.format(key, results[key] * 1e6))
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Names of results slower than their baseline by more than threshold"""
+    regressions = []
+    for key, seconds in results.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        change = seconds / before - 1
+        flag = 'REGRESSION' if change > threshold else ''
+        print('{:<36} {:+7.1%} {}'.format(key, change, flag))
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='selected', action='append',
+                        help="Run only cases whose name contains this")
+    parser.add_argument('--users', type=int, default=5000, help="Users in the dataset")
+    parser.add_argument('--baseline', help="Baseline file, per database by default")
+    parser.add_argument('--save', action='store_true', help="Write results as the baseline")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Slowdown flagged as a regression, 0.2 is 20%%")
+    args = parser.parse_args(argv)
+
+    app = bench_app()
+    with app.app_context():
+        populate(args.users)
+        dialect = db.engine.dialect.name
+        results = run(app, args.selected)
+        db.session.remove()
+        db.drop_all()
+
+    path = args.baseline or os.path.join(BASELINES, '{}.json'.format(dialect))
+    if args.save:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'python': platform.python_version(), 'database': dialect,
+                       'users': args.users, 'results': results}, f, indent=2)
+        print('baseline written to {}'.format(path))
+        return 0
+
+    if not os.path.exists(path):
+        print('no baseline at {}, record one with --save'.format(path))
+        return 1
+
+    with open(path) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline['results'], args.threshold)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""
+Gunicorn settings, run with
+
+    gunicorn -c gunicorn.conf.py app.wsgi:app
+
+Everything below reads its GUNICORN_* environment variable first. Workers
+default to threaded (gthread), two per core plus one with GUNICORN_THREADS
+threads each. GUNICORN_WORKER_CLASS=gevent or eventlet serves cooperatively
+instead, one worker per core with up to GUNICORN_WORKER_CONNECTIONS greenlets;
+the standard library and psycopg2 are patched before the app is loaded, install
+the matching extra (pip install -e .[gevent]). Size DB_POOL_SIZE and
+DB_MAX_OVERFLOW for the threads or greenlets of one worker, requests beyond
+them wait up to DB_POOL_TIMEOUT for a connection.
+"""
+import os
+import shutil
+import tempfile
+
+
+def cores():
+    # the CPUs this container may run on, not those of the host
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def patch_psycopg(worker_class):
+    """Wait for psycopg2 sockets in the event loop instead of blocking the worker"""
+    import psycopg2
+    from psycopg2 import extensions
+
+    if worker_class == 'gevent':
+        from gevent.socket import wait_read, wait_write
+    else:
+        from eventlet.hubs import trampoline
+
+        def wait_read(fileno):
+            trampoline(fileno, read=True)
+
+        def wait_write(fileno):
+            trampoline(fileno, write=True)
+
+    def wait_callback(conn):
+        while True:
+            state = conn.poll()
+            if state == extensions.POLL_OK:
+                break
+            elif state == extensions.POLL_READ:
+                wait_read(conn.fileno())
+            elif state == extensions.POLL_WRITE:
+                wait_write(conn.fileno())
+            else:
+                raise psycopg2.OperationalError('Bad result from poll: {!r}'.format(state))
+
+    extensions.set_wait_callback(wait_callback)
+
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:6000')
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+cooperative = worker_class in ('gevent', 'eventlet')
+workers = int(os.environ.get('GUNICORN_WORKERS', cores() if cooperative else cores() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 1 if cooperative else 4))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# built once in the master and shared copy on write, workers start in milliseconds
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# recycle workers now and then, jittered so they don't all restart at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+accesslog = os.environ.get('GUNICORN_ACCESSLOG')
+
+if cooperative:
+    # before the preloaded app imports socket, threading and psycopg2
+    if worker_class == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    else:
+        import eventlet
+        eventlet.monkey_patch()
+    patch_psycopg(worker_class)
+
+# every worker writes its metrics here, /metrics aggregates them. Emptied now,
+# before a preloaded app creates its metrics, samples left by a previous master
+# would be added to the new ones
+multiproc_dir = os.environ.setdefault(
+    'prometheus_multiproc_dir', os.path.join(tempfile.gettempdir(), 'prometheus'))
+shutil.rmtree(multiproc_dir, ignore_errors=True)
+os.makedirs(multiproc_dir)
+
+
+def post_fork(server, worker):
+    # a preloaded app was built in the master, its connections are not the worker's
+    if server.cfg.preload_app:
+        from app.extensions import reset_connections
+        reset_connections(server.app.wsgi())
+
+
+def child_exit(server, worker):
+    from app.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
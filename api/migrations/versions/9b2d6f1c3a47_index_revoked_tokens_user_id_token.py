@@ -0,0 +1,24 @@
+"""Index revoked_tokens on user_id and token
+
+Revision ID: 9b2d6f1c3a47
+Revises: 4642188e08cf
+Create Date: 2026-10-18 09:12:41.318204
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9b2d6f1c3a47'
+down_revision = '4642188e08cf'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_revoked_tokens_user_id_token', 'revoked_tokens',
+                    ['user_id', 'token'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_revoked_tokens_user_id_token', table_name='revoked_tokens')
@@ -0,0 +1,28 @@
+"""Partial indexes on active rows for users and revoked_tokens
+
+Revision ID: c41e8a7d2f90
+Revises: 9b2d6f1c3a47
+Create Date: 2026-10-18 11:04:27.562913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41e8a7d2f90'
+down_revision = '9b2d6f1c3a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_users_created_at_id_active', 'users', ['created_at', 'id'],
+                    unique=False, postgresql_where=sa.text('active'))
+    op.create_index('ix_revoked_tokens_user_id_token_active', 'revoked_tokens',
+                    ['user_id', 'token'], unique=False, postgresql_where=sa.text('active'))
+
+
+def downgrade():
+    op.drop_index('ix_revoked_tokens_user_id_token_active', table_name='revoked_tokens')
+    op.drop_index('ix_users_created_at_id_active', table_name='users')
@@ -0,0 +1,39 @@
+"""Timestamps of users and revoked_tokens are never NULL
+
+Revision ID: e7b3c9d1a5f2
+Revises: c41e8a7d2f90
+Create Date: 2026-10-18 16:21:08.904117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b3c9d1a5f2'
+down_revision = 'c41e8a7d2f90'
+branch_labels = None
+depends_on = None
+
+TABLES = ('users', 'revoked_tokens')
+NOW = "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
+def upgrade():
+    for table in TABLES:
+        op.execute('UPDATE {0} SET created_at = COALESCE(modified_at, {1}) '
+                   'WHERE created_at IS NULL'.format(table, NOW))
+        op.execute('UPDATE {} SET modified_at = created_at '
+                   'WHERE modified_at IS NULL'.format(table))
+        op.alter_column(table, 'created_at', existing_type=sa.DateTime(), nullable=False,
+                        existing_server_default=sa.text(NOW))
+        op.alter_column(table, 'modified_at', existing_type=sa.DateTime(), nullable=False,
+                        existing_server_default=sa.text(NOW))
+
+
+def downgrade():
+    for table in TABLES:
+        op.alter_column(table, 'modified_at', existing_type=sa.DateTime(), nullable=True,
+                        existing_server_default=sa.text(NOW))
+        op.alter_column(table, 'created_at', existing_type=sa.DateTime(), nullable=True,
+                        existing_server_default=sa.text(NOW))
@@ -30,8 +30,27 @@ setup(
         'gunicorn==19.9.0',
         'voluptuous==0.11.5',
         'python-dotenv==0.10.1',
-        'inflection==0.3.1'
+        'inflection==0.3.1',
+        'prometheus-client==0.7.1'
     ],
+    extras_require={
+        # C accelerated JSON encoding picked up by JSON_BACKEND=auto
+        'speedups': ['orjson'],
+        # cooperative gunicorn workers, GUNICORN_WORKER_CLASS=gevent or eventlet
+        'gevent': ['gevent'],
+        'eventlet': ['eventlet'],
+    },
+    entry_points={
+        # commands the flask CLI finds without building the app
+        'flask.commands': [
+            'test=app.commands:test',
+            'initdb=app.commands:initdb',
+            'export=app.commands:export',
+            'import-users=app.commands:import_users',
+            'seed=app.commands:seed_data',
+            'loadtest=app.commands:load_test',
+        ],
+    },
     classifiers=[
         'Development Status :: 1 - Alpha',
         'Environment :: Application Programming Interface',